@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batching utilities, split a sequence, an iterator or a stream into chunks.
+
+- :func:`grouper_slice`: sequence, by slicing, fastest.
+- :func:`grouper_islice`: any iterable, by :func:`itertools.islice`.
+- :func:`grouper_list`: any iterable, item by item with a counter.
+- :func:`grouper_bytes`: any iterable, by count and by byte size.
+- :func:`grouper_time`: a :class:`queue.Queue`, by count and by waiting time.
+
+Run this script to test them and benchmark them.
+"""
+
+from __future__ import print_function
+import time
+from itertools import islice
+
+try:  # for Python2
+    from itertools import izip_longest as zip_longest
+    from Queue import Empty
+except ImportError:
+    from itertools import zip_longest
+    from queue import Empty
+
+
+def grouper_slice(seq, n):
+    """Evenly divide a sequence into fixed-length piece by slicing, the last
+    piece may be shorter.
+
+    Slicing a ``list`` copies only the item references, in C. Slicing a
+    ``memoryview`` copies nothing.
+
+    Example::
+
+        >>> list(grouper_slice(list(range(10)), n=3))
+        [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    """
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
+
+def grouper_islice(iterable, n):
+    """Evenly divide any iterable into fixed-length list, the last list may be
+    shorter. Items are pulled ``n`` at a time with :func:`itertools.islice`.
+    """
+    iterator = iter(iterable)
+    while 1:
+        chunk = list(islice(iterator, n))
+        if not chunk:
+            break
+        yield chunk
+
+
+def grouper_list(l, n):
+    """Evenly divide list into fixed-length piece, no filled value if chunk
+    size smaller than fixed-length.
+
+    Example::
+
+        >>> list(grouper_list(range(10), n=3))
+        [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+
+    **中文文档**
+
+    将一个列表按照尺寸n, 依次打包输出, 有多少输出多少, 并不强制填充包的大小到n。
+
+    本函数使用的是方法1, 有三种实现:
+
+    - 方法1: 建立一个counter, 在向chunk中添加元素时, 同时将counter与n比较, 如果一致
+      则yield。然后在最后将剩余的item视情况yield。
+    - 方法2: 建立一个list, 每次添加一个元素, 并检查size。
+    - 方法3: 调用grouper()函数, 然后对里面的填充元素进行清理。
+
+    运行本脚本的benchmark可以看到, 在CPython3上, 方法1和方法2速度相当, 而方法3
+    由于在C中完成分组, 反而比它们快2到6倍。对于序列, :func:`grouper_slice` 最快;
+    对于任意的可迭代对象, :func:`grouper_islice` 与方法3相当, 且不需要清理填充元素。
+    """
+    chunk = list()
+    counter = 0
+    for item in l:
+        counter += 1
+        chunk.append(item)
+        if counter == n:
+            yield chunk
+            chunk = list()
+            counter = 0
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _grouper_list_len(l, n):
+    """方法2, 仅用于benchmark。
+    """
+    chunk = list()
+    for item in l:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = list()
+    if len(chunk) > 0:
+        yield chunk
+
+
+_fill = object()
+
+
+def _grouper_list_fill(l, n):
+    """方法3, 仅用于benchmark。
+    """
+    for chunk in zip_longest(*[iter(l)] * n, fillvalue=_fill):
+        if chunk[-1] is _fill:
+            chunk = [item for item in chunk if item is not _fill]
+        yield list(chunk)
+
+
+def grouper_bytes(iterable, n, max_bytes, sizeof=len):
+    """Group items from any iterable into lists of at most ``n`` items and at
+    most ``max_bytes`` bytes, where ``sizeof(item)`` is the byte size of an
+    item. An item larger than ``max_bytes`` makes a list of its own.
+    """
+    chunk = list()
+    n_bytes = 0
+    for item in iterable:
+        size = sizeof(item)
+        if chunk and (len(chunk) == n or n_bytes + size > max_bytes):
+            yield chunk
+            chunk = list()
+            n_bytes = 0
+        chunk.append(item)
+        n_bytes += size
+    if chunk:
+        yield chunk
+
+
+def grouper_time(q, n, timeout, sentinel=None):
+    """Group items from a :class:`queue.Queue` into lists of at most ``n``
+    items. A list is yielded at the latest ``timeout`` seconds after its first
+    item arrived, even if no more item arrives. Stop when ``sentinel`` is got.
+
+    Use it to batch a stream from a producer thread, so that a slow stream
+    still gets its items handled in time.
+    """
+    chunk = list()
+    deadline = None
+    while 1:
+        try:
+            if deadline is None:
+                item = q.get()
+            else:
+                item = q.get(timeout=max(deadline - time.time(), 0))
+        except Empty:
+            yield chunk
+            chunk = list()
+            deadline = None
+            continue
+        if item is sentinel:
+            break
+        if deadline is None:
+            deadline = time.time() + timeout
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = list()
+            deadline = None
+    if chunk:
+        yield chunk
+
+
+if __name__ == "__main__":
+    import threading
+    try:
+        from Queue import Queue
+    except ImportError:
+        from queue import Queue
+
+    def test_grouper():
+        expected = [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+        for grouper in [grouper_list, _grouper_list_len, _grouper_list_fill,
+                        grouper_islice]:
+            assert list(grouper(iter(range(10)), 3)) == expected
+            assert list(grouper(iter([]), 3)) == []
+        assert list(grouper_slice(list(range(10)), 3)) == expected
+        assert list(grouper_slice(list(range(9)), 3)) == expected[:3]
+        view = memoryview(b"abcdefg")
+        assert [bytes(chunk) for chunk in grouper_slice(view, 3)] == \
+            [b"abc", b"def", b"g"]
+
+    test_grouper()
+
+    def test_grouper_bytes():
+        items = ["a", "bb", "ccc", "dddd", "e"]
+        assert list(grouper_bytes(items, 10, 3)) == \
+            [["a", "bb"], ["ccc"], ["dddd"], ["e"]]
+        assert list(grouper_bytes(items, 2, 100)) == \
+            [["a", "bb"], ["ccc", "dddd"], ["e"]]
+
+    test_grouper_bytes()
+
+    def test_grouper_time():
+        q = Queue()
+
+        def produce():
+            for i in range(5):
+                q.put(i)
+            time.sleep(0.2)  # a pause in the stream
+            for i in range(5, 7):
+                q.put(i)
+            q.put(None)
+
+        thread = threading.Thread(target=produce)
+        thread.start()
+        chunks = list(grouper_time(q, n=3, timeout=0.05))
+        thread.join()
+        assert chunks == [[0, 1, 2], [3, 4], [5, 6]]
+
+    test_grouper_time()
+
+    def benchmark_grouper(n_item=1000000, sizes=(10, 1000), repeat=3):
+        """Validate the performance ordering of :func:`grouper_list`
+        docstring, and compare with :func:`grouper_islice` and
+        :func:`grouper_slice`.
+        """
+        data = list(range(n_item))
+        for n in sizes:
+            print("--- grouper, %s items, n = %s ---" % (n_item, n))
+            for name, grouper, make_input in [
+                ("method1, counter, grouper_list", grouper_list, iter),
+                ("method2, len check", _grouper_list_len, iter),
+                ("method3, fill then strip", _grouper_list_fill, iter),
+                ("grouper_islice", grouper_islice, iter),
+                ("grouper_slice", grouper_slice, list),
+            ]:
+                timing = list()
+                for _ in range(repeat):
+                    source = make_input(data)
+                    st = time.time()
+                    for _ in grouper(source, n):
+                        pass
+                    timing.append(time.time() - st)
+                print("%s: elapsed %.6f seconds." % (name, min(timing)))
+
+    benchmark_grouper()
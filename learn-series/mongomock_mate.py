@@ -4,12 +4,21 @@
 """
 mongomock_mate is a simple script adding a data persistent layer to allow to
 use mongomock as fake MongoDB.
+
+:func:`dump_db` / :func:`load_db` write and read the whole database as one
+json file. :func:`dump_db_jsonl` / :func:`load_db_jsonl` stream a snapshot
+directory, one JSON Lines file per collection, one document at a time, and
+can load collections lazily on first access.
 """
 
 from __future__ import unicode_literals
+import io
+import os
 from collections import OrderedDict
 from superjson import json
 
+from batching import grouper_islice
+
 
 def dump_db(db, path, verbose=True):
     data = OrderedDict()
@@ -36,6 +45,140 @@ def load_db(db, path, verbose=True):
         col._uniques = col_data["_uniques"]
 
 
+META_FILE = "_meta.json"
+
+
+def _collection_names(db):
+    try:
+        names = db.list_collection_names()
+    except AttributeError:  # old pymongo / mongomock
+        names = db.collection_names()
+    return [name for name in names if name != "system.indexes"]
+
+
+def _collection_file(path, col_name):
+    return os.path.join(path, "%s.jsonl" % col_name)
+
+
+def dump_db_jsonl(db, path, verbose=True):
+    """Dump ``db`` into directory ``path``: ``_meta.json`` holds the database
+    name, and the collection names and indexes, ``<collection>.jsonl`` holds
+    one document per line. Documents are read with ``find()`` and written one
+    at a time, so memory use does not grow with the database size.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    meta = OrderedDict()
+    meta["name"] = db.name
+    meta["_collections"] = OrderedDict()
+    for col_name in _collection_names(db):
+        col = db.get_collection(col_name)
+        meta["_collections"][col_name] = OrderedDict([
+            ("_indexes", [
+                {"key": index["key"], "unique": index.get("unique", False)}
+                for name, index in col.index_information().items()
+                if name != "_id_"
+            ]),
+        ])
+        n_doc = 0
+        with io.open(_collection_file(path, col_name), "w",
+                     encoding="utf-8") as f:
+            for doc in col.find():
+                f.write(json.dumps(doc, ensure_ascii=False))
+                f.write("\n")
+                n_doc += 1
+        if verbose:
+            print("dump %s documents of %r." % (n_doc, col_name))
+
+    with io.open(os.path.join(path, META_FILE), "w", encoding="utf-8") as f:
+        f.write(json.dumps(meta, ensure_ascii=False))
+
+
+def iter_jsonl_documents(path):
+    """Yield documents of a collection file one at a time.
+    """
+    with io.open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_collection_jsonl(col, path, indexes=(), batch_size=1000):
+    """Insert documents of a collection file into ``col``, ``batch_size`` at a
+    time, and create its ``indexes``. Return the number of documents.
+    """
+    for index in indexes:
+        col.create_index(
+            [tuple(key) for key in index["key"]], unique=index["unique"])
+    n_doc = 0
+    for chunk in grouper_islice(iter_jsonl_documents(path), batch_size):
+        col.insert_many(chunk)
+        n_doc += len(chunk)
+    return n_doc
+
+
+class LazyDatabase(object):
+    """Wrap a database, load a collection of a snapshot the first time it is
+    accessed, by attribute, by key or by :meth:`get_collection`. Anything else
+    goes to the wrapped database.
+    """
+
+    def __init__(self, db, path, meta, verbose=True):
+        self._db = db
+        self._path = path
+        self._pending = OrderedDict(meta["_collections"])  # not loaded yet
+        self._verbose = verbose
+
+    def get_collection(self, name, *args, **kwargs):
+        col = self._db.get_collection(name, *args, **kwargs)
+        if name in self._pending:
+            col_meta = self._pending.pop(name)
+            n_doc = load_collection_jsonl(
+                col, _collection_file(self._path, name), col_meta["_indexes"])
+            if self._verbose:
+                print("load %s documents of %r." % (n_doc, name))
+        return col
+
+    def __getitem__(self, name):
+        return self.get_collection(name)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self._pending:
+            return self.get_collection(name)
+        return getattr(self._db, name)
+
+    def list_collection_names(self):
+        names = _collection_names(self._db)
+        return names + [name for name in self._pending if name not in names]
+
+    def load_all(self):
+        """Load every collection not loaded yet.
+        """
+        for name in list(self._pending):
+            self.get_collection(name)
+        return self._db
+
+
+def load_db_jsonl(db, path, lazy=True, verbose=True):
+    """Load a snapshot written by :func:`dump_db_jsonl` into ``db``.
+
+    With ``lazy=True`` return a :class:`LazyDatabase`, a collection is read
+    from disk on first access. Otherwise load everything now and return
+    ``db``. Either way a collection file is read one line at a time.
+    """
+    with io.open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+        meta = json.loads(f.read())
+    if meta["name"] != db.name:
+        raise ValueError("Wrong database file!")
+
+    lazy_db = LazyDatabase(db, path, meta, verbose=verbose)
+    if lazy:
+        return lazy_db
+    return lazy_db.load_all()
+
 
 if __name__ =="__main__":
     import mongomock
@@ -75,4 +218,47 @@ if __name__ =="__main__":
         print(list(db.item.find()))
         print(list(db.order.find()))
 
+    def test_jsonl():
+        import shutil
+        import tempfile
+
+        db = mongomock.MongoClient().db
+        db.user.insert_many([
+            {"_id": 1, "name": "Alice", "token": "g50!FvEd2eED".encode("utf-8")},
+            {"_id": 2, "name": "Bob", "token": "2hF*nOv4*2f%".encode("utf-8")},
+        ])
+        db.user.create_index("name", unique=True)
+        db.order.insert_many([
+            {"_id": i, "user": i % 2 + 1, "create_at": datetime(2017, 1, 1)}
+            for i in range(2500)
+        ])
+
+        path = tempfile.mkdtemp()
+        try:
+            dump_db_jsonl(db, path, verbose=False)
+
+            new_db = load_db_jsonl(
+                mongomock.MongoClient().db, path, verbose=False)
+            assert sorted(new_db._pending) == ["order", "user"]
+            assert list(new_db.user.find()) == list(db.user.find())
+            assert list(new_db._pending) == ["order"]  # loaded on access
+            assert sorted(new_db.list_collection_names()) == ["order", "user"]
+            assert list(new_db["order"].find()) == list(db.order.find())
+            assert not new_db._pending
+            assert new_db.name == db.name
+            try:
+                new_db.user.insert_one({"_id": 3, "name": "Alice"})
+                raise AssertionError("unique index is not loaded")
+            except Exception as e:
+                assert "Duplicate" in str(e)
+
+            new_db = load_db_jsonl(
+                mongomock.MongoClient().db, path, lazy=False, verbose=False)
+            assert list(new_db.order.find()) == list(db.order.find())
+        finally:
+            shutil.rmtree(path)
+
+    # test_jsonl only uses the public pymongo api, run it before test, which
+    # needs the ``_collections`` attribute of old mongomock
+    test_jsonl()
     test()
\ No newline at end of file
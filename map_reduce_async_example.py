@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+asyncio runner for the Simple Python MapReduce Framework, for mapper doing
+I/O, such as fetching documents or querying stores.
+
+``mapper`` and ``reducer`` can be ``async def`` or regular methods,
+``distributter`` can return an async iterator or a regular iterable. Records
+go through a bounded queue, so the distributter is paused while
+``concurrency`` mappers are busy.
+
+Python3.7+ only.
+"""
+
+import time
+import asyncio
+import inspect
+from collections import defaultdict
+
+from map_reduce_example import MapReduce, WordCount, data, _merge_runs
+
+_done = object()  # tells a mapper worker to stop
+
+
+async def _aiter(iterable):
+    """Iterate an async iterator or a regular iterable.
+    """
+    if hasattr(iterable, "__aiter__"):
+        async for item in iterable:
+            yield item
+    else:
+        for item in iterable:
+            yield item
+
+
+async def _maybe_await(value):
+    if inspect.isawaitable(value):
+        value = await value
+    return value
+
+
+class AsyncMapReduce(MapReduce):
+
+    concurrency = 10  # max number of mapper running at the same time
+
+    async def execute(self):
+        """Execute Map Reduce, run mappers concurrently.
+
+        Mappers may finish in any order, so the order of keys in
+        intermediate, and of ``result``, may differ from the serial path.
+        Reducers are awaited one by one.
+        """
+        await self._map_async()
+        await self._reduce_async()
+
+    async def _map_async(self):
+        """Feed records from ``distributter()`` to ``concurrency`` mapper
+        workers through a bounded queue.
+
+        Values emitted by every ``batch_size`` records are merged into
+        intermediate with ``combiner`` and ``memory_budget`` applied, same as
+        the serial path. Merging is synchronous, so no emitted value is lost
+        while other mappers are awaiting.
+        """
+        buffered = self.combiner is not None or self.memory_budget is not None
+        store = self.intermediate
+        if buffered:
+            self.intermediate = defaultdict(list)
+
+        def flush():
+            intermediate = self.intermediate
+            self.intermediate = defaultdict(list)
+            self._n_values += self._merge_into(store, intermediate)
+            self._check_memory_budget(store)
+
+        queue = asyncio.Queue(maxsize=self.concurrency)
+        n_mapped = [0, ]
+
+        async def produce():
+            async for record in _aiter(self.distributter()):
+                await queue.put(record)
+            for _ in range(self.concurrency):
+                await queue.put(_done)
+
+        async def consume():
+            while 1:
+                record = await queue.get()
+                if record is _done:
+                    break
+                await _maybe_await(self.mapper(record))
+                n_mapped[0] += 1
+                if buffered and n_mapped[0] % self.batch_size == 0:
+                    flush()
+
+        tasks = [asyncio.ensure_future(produce()), ] + [
+            asyncio.ensure_future(consume()) for _ in range(self.concurrency)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            if buffered:
+                flush()
+                self.intermediate = store
+
+    async def _reduce_async(self):
+        """Await ``reducer`` on each key, stream the spilled runs if any.
+        """
+        if not self._runs:
+            for key, value in self.intermediate.items():
+                await _maybe_await(self.reducer(key, value))
+            return
+
+        try:
+            if self.intermediate:
+                self._spill(self.intermediate)
+            for key, values in _merge_runs(self._runs):
+                await _maybe_await(self.reducer(key, values))
+        finally:
+            for f in self._runs:
+                f.close()
+            self._runs = list()
+
+
+class AsyncWordCount(AsyncMapReduce, WordCount):
+    """WordCount pretending each book has to be downloaded first.
+    """
+    latency = 0.05
+
+    async def distributter(self):
+        for record in data:
+            yield record
+
+    async def mapper(self, record):
+        await asyncio.sleep(self.latency)  # fetch the book
+        WordCount.mapper(self, record)
+
+
+if __name__ == "__main__":
+    expected = WordCount()
+    expected.execute()
+
+    for concurrency in [1, 5, 10]:
+        wc = AsyncWordCount()
+        wc.concurrency = concurrency
+        st = time.time()
+        asyncio.run(wc.execute())
+        assert sorted(wc.result) == sorted(expected.result)
+        print("concurrency = %s: %.3f sec" % (concurrency, time.time() - st))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for the Simple Python MapReduce Framework in map_reduce_example.py
+
+The WordCount corpus is the ten-book ``data`` list repeated ``n_copy`` times.
+"""
+
+from __future__ import print_function
+import os
+import time
+import random
+
+from map_reduce_example import WordCount, data
+
+corpus = list()
+
+
+def make_corpus(n_copy):
+    """Repeat the ten-book ``data`` list ``n_copy`` times.
+    """
+    return [
+        ("%s-%s" % (title, i), content)
+        for i in range(n_copy)
+        for title, content in data
+    ]
+
+
+def make_vocabulary_corpus(n_record, n_word=1000, n_vocabulary=200000):
+    """Random records drawn from a large vocabulary, most keys are rare.
+    """
+    vocabulary = ["w%s" % i for i in range(n_vocabulary)]
+    return [
+        ("record-%s" % i, " ".join(random.sample(vocabulary, n_word)))
+        for i in range(n_record)
+    ]
+
+
+class CorpusWordCount(WordCount):
+
+    def distributter(self):
+        return iter(corpus)
+
+
+class LegacyWordCount(CorpusWordCount):
+    """WordCount with the original exception-driven emit path.
+    """
+    combiner = None
+
+    def __init__(self):
+        super(LegacyWordCount, self).__init__()
+        self.intermediate = dict()
+
+    def emit_intermediate(self, key, value):
+        try:
+            self.intermediate[key].append(value)
+        except:
+            self.intermediate[key] = [value, ]
+
+    def mapper(self, record):
+        words = record[1].split()
+        for w in words:
+            self.emit_intermediate(w, 1)
+
+
+class EmitOneWordCount(CorpusWordCount):
+    """WordCount calling the new ``emit_intermediate`` once per word.
+    """
+    combiner = None
+
+    def mapper(self, record):
+        for w in record[1].split():
+            self.emit_intermediate(w, 1)
+
+
+class EmitManyWordCount(CorpusWordCount):
+    """WordCount using ``emit_intermediate_many``.
+    """
+    combiner = None
+
+
+def benchmark_parallel(n_copy=2000, workers=(None, 1, 2, 4)):
+    """Show how ``MapReduce.execute(processes=n)`` scales with worker count.
+    """
+    corpus[:] = make_corpus(n_copy)
+    print("--- parallel execute, %s records ---" % len(corpus))
+
+    expected = None
+    for processes in workers:
+        wc = CorpusWordCount()
+        st = time.time()
+        wc.execute(processes=processes)
+        elapsed = time.time() - st
+        if expected is None:
+            expected = wc.result
+        assert wc.result == expected
+        print("processes = %s: %.3f sec" % (processes, elapsed))
+
+
+def benchmark_emit_intermediate(n_record=500, repeat=3):
+    """Compare the map phase of the old and new emit path on a vocabulary
+    heavy corpus.
+    """
+    corpus[:] = make_vocabulary_corpus(n_record)
+    print("--- emit intermediate, %s records ---" % len(corpus))
+
+    for klass in [LegacyWordCount, EmitOneWordCount, EmitManyWordCount]:
+        timing = list()
+        for _ in range(repeat):
+            wc = klass()
+            st = time.time()
+            for record in wc.distributter():
+                wc.mapper(record)
+            timing.append(time.time() - st)
+        print("%s: %.3f sec" % (klass.__name__, min(timing)))
+
+
+def benchmark_execute(n_copy=3000, batch_sizes=(100, 1000), repeat=5):
+    """End to end ``execute()`` of the original emit path, of
+    ``emit_intermediate_many`` without combiner, and of the default
+    ``WordCount`` with combiner at several ``batch_size``.
+    """
+    corpus[:] = make_corpus(n_copy)
+    print("--- execute, %s records ---" % len(corpus))
+
+    cases = [
+        ("original emit path", LegacyWordCount, None),
+        ("emit_intermediate_many", EmitManyWordCount, None),
+    ] + [
+        ("combiner, batch_size = %s" % batch_size, CorpusWordCount, batch_size)
+        for batch_size in batch_sizes
+    ]
+    for name, klass, batch_size in cases:
+        timing = list()
+        for _ in range(repeat):
+            wc = klass()
+            if batch_size is not None:
+                wc.batch_size = batch_size
+            st = time.time()
+            wc.execute()
+            timing.append(time.time() - st)
+        print("%s: %.3f sec" % (name, min(timing)))
+
+
+def benchmark_execute_bulk(n_copy=5000, workers=(1, 2, 4),
+                           chunksizes=(100, 1000)):
+    """Compare ``WordCount.execute`` and ``WordCount.execute_bulk`` on a
+    multi-megabyte corpus, then sweep ``execute_bulk(processes=n)`` over
+    worker counts and chunk sizes.
+    """
+    corpus[:] = make_corpus(n_copy)
+    n_bytes = sum(len(content) for _, content in corpus)
+    print("--- bulk word count, %.1f MB ---" % (n_bytes / 1000000.0))
+
+    wc_legacy = LegacyWordCount()
+    st = time.time()
+    wc_legacy.execute()
+    print("execute, original emit path: %.3f sec" % (time.time() - st))
+
+    wc = CorpusWordCount()
+    st = time.time()
+    wc.execute()
+    print("execute: %.3f sec" % (time.time() - st))
+
+    wc_bulk = CorpusWordCount()
+    st = time.time()
+    wc_bulk.execute_bulk()
+    print("execute_bulk: %.3f sec" % (time.time() - st))
+
+    assert wc_bulk.result == wc.result == wc_legacy.result
+
+    print("%s cpu" % os.cpu_count())
+    for chunksize in chunksizes:
+        for processes in workers:
+            wc_parallel = CorpusWordCount()
+            st = time.time()
+            wc_parallel.execute_bulk(processes=processes, chunksize=chunksize)
+            print("execute_bulk, processes = %s, chunksize = %s: %.3f sec" % (
+                processes, chunksize, time.time() - st))
+            assert wc_parallel.result == wc_bulk.result
+
+
+if __name__ == "__main__":
+    benchmark_parallel()
+    benchmark_emit_intermediate()
+    benchmark_execute()
+    benchmark_execute_bulk()
@@ -21,41 +21,956 @@ OUTPUT::
     ]
 """
 
+import io
+import os
+import sys
+import copy
+import mmap
+import glob
+import shutil
+import json
+import heapq
+import pickle
+import sqlite3
+import hashlib
+import cProfile
+import pstats
+import tempfile
+import tracemalloc
+from time import perf_counter
 from pprint import pprint
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict, Counter
+from operator import itemgetter
+from itertools import islice, groupby, chain, repeat, count
+from multiprocessing import Pool
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def grouper(iterable, n):
+    """Yield list of at most ``n`` items from ``iterable``, without loading
+    the whole iterable into memory.
+    """
+    iterator = iter(iterable)
+    while 1:
+        chunk = list(islice(iterator, n))
+        if not chunk:
+            break
+        yield chunk
+
+
+# --- process pool workers ---
+_worker_job = None
+
+
+def _init_worker(job):
+    """Install a private copy of the MapReduce job in a worker process.
+    """
+    global _worker_job
+    _worker_job = job
+
+
+# --- spilled runs ---
+def _write_run(items, dir=None):
+    """Write sorted items to a temp file, one pickle per item.
+    """
+    f = tempfile.TemporaryFile(dir=dir)
+    for item in items:
+        pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+    return f
+
+
+def _read_run(f):
+    """Yield the items of a spilled run.
+    """
+    f.seek(0)
+    while 1:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            break
+
+
+def _count_emitted(group, n_emitted):
+    """Yield the ``list_of_values`` of ``(key, n_emitted, list_of_values)``
+    items, add up their ``n_emitted`` into ``n_emitted[0]``.
+    """
+    for _, n, list_of_values in group:
+        n_emitted[0] += n
+        yield list_of_values
+
+
+def _merge_runs(runs, largest_keys=None):
+    """K-way merge spilled runs of ``(key, n_emitted, list_of_values)``,
+    yield ``(key, iterator of values)`` in key order. The iterator has to be
+    consumed before the next key is yielded.
+
+    :param largest_keys: a :class:`TopK` receiving ``(key, n_emitted)``
+      summed over all runs, once the key has been handled.
+    """
+    merged = heapq.merge(*[_read_run(f) for f in runs], key=itemgetter(0))
+    for key, group in groupby(merged, key=itemgetter(0)):
+        n_emitted = [0, ]
+        lists = _count_emitted(group, n_emitted)
+        yield key, chain.from_iterable(lists)
+        if largest_keys is not None:
+            for _ in lists:  # the part of the group the reducer skipped
+                pass
+            largest_keys.append((key, n_emitted[0]))
+
+
+def _map_worker(records):
+    """Map a chunk of records, return the partial intermediate and the number
+    of values emitted per key, None if intermediate is not combined.
+    """
+    _worker_job.intermediate = defaultdict(list)
+    _worker_job._emit_counts = dict()
+    _worker_job._map(records)
+    if _worker_job.combiner is None:
+        return _worker_job.intermediate, None
+    return _worker_job.intermediate, _worker_job._emit_counts
+
+
+def _reduce_worker(partition):
+    """Reduce a partition of ``(key, list_of_values)``, return a dict of
+    ``key: list of emitted value``.
+    """
+    _worker_job.result = list()
+    output = dict()
+    for key, list_of_values in partition:
+        n = len(_worker_job.result)
+        _worker_job.reducer(key, list_of_values)
+        output[key] = _worker_job.result[n:]
+    return output
+
+
+# --- result sinks ---
+class TopK(object):
+    """Replacement of the ``result`` list which only keeps the ``k`` largest
+    emitted values in a bounded heap, memory is O(k).
+
+    Example::
+
+        wc = WordCount()
+        wc.result = TopK(10, key=itemgetter(1))  # 10 most common words
+        wc.execute()
+
+    :param key: sort key of emitted value. On ties, first emitted wins.
+    """
+
+    def __init__(self, k, key=None):
+        self.k = k
+        self.key = key
+        self._heap = list()
+        self._counter = count()
+
+    def append(self, value):
+        sort_key = value if self.key is None else self.key(value)
+        item = (sort_key, -next(self._counter), value)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        """Iterate values from the largest.
+        """
+        return iter([item[2] for item in sorted(self._heap, reverse=True)])
+
+
+class SortedFileWriter(object):
+    """Replacement of the ``result`` list which writes emitted values to a
+    file, one ``dumps(value)`` per line, sorted by ``key``. At most
+    ``buffer_size`` values are kept in memory, sorted runs are spilled to
+    temp files and k-way merged on :meth:`close`.
+
+    Example::
+
+        with SortedFileWriter("words.jsonl", key=itemgetter(1)) as result:
+            wc = WordCount()
+            wc.result = result
+            wc.execute()
+    """
+
+    def __init__(self, path, key=None, reverse=False, buffer_size=100000,
+                 dumps=json.dumps, loads=json.loads, spill_dir=None):
+        self.path = path
+        self.key = key
+        self.reverse = reverse
+        self.buffer_size = buffer_size
+        self.dumps = dumps
+        self.loads = loads
+        self.spill_dir = spill_dir
+        self._buffer = list()
+        self._runs = list()
+
+    def append(self, value):
+        self._buffer.append(value)
+        if len(self._buffer) >= self.buffer_size:
+            self._spill()
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def _spill(self):
+        self._buffer.sort(key=self.key, reverse=self.reverse)
+        self._runs.append(_write_run(self._buffer, dir=self.spill_dir))
+        self._buffer = list()
+
+    def close(self):
+        """Write all values to ``path``.
+        """
+        if self._runs:
+            if self._buffer:
+                self._spill()
+            values = heapq.merge(
+                *[_read_run(f) for f in self._runs],
+                key=self.key, reverse=self.reverse)
+        else:
+            self._buffer.sort(key=self.key, reverse=self.reverse)
+            values = self._buffer
+
+        try:
+            with io.open(self.path, "w", encoding="utf-8") as f:
+                for value in values:
+                    f.write(self.dumps(value))
+                    f.write("\n")
+        finally:
+            for f in self._runs:
+                f.close()
+            self._runs = list()
+            self._buffer = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        """Read back the written values.
+        """
+        with io.open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield self.loads(line)
+
+
+# --- metrics ---
+class _TimedIterator(object):
+    """Wrap an iterator, measure the time spent producing items.
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.elapsed = 0.0
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        st = perf_counter()
+        try:
+            item = next(self.iterator)
+        finally:
+            self.elapsed += perf_counter() - st
+        self.count += 1
+        return item
+
+    next = __next__
+
+
+def _approx_nbytes(intermediate, n_value, n_sample=1000):
+    """Approximate memory used by intermediate, values size are estimated
+    from a sample.
+    """
+    nbytes = sys.getsizeof(intermediate)
+    sample = list()
+    for key, list_of_values in intermediate.items():
+        nbytes += sys.getsizeof(key) + sys.getsizeof(list_of_values)
+        if len(sample) < n_sample and list_of_values:
+            sample.append(sys.getsizeof(list_of_values[0]))
+    if sample:
+        nbytes += int(n_value * sum(sample) / len(sample))
+    return nbytes
+
+
+def _peak_rss():
+    """Peak resident memory of the current process in bytes.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # bytes on Mac, kilobytes on Linux
+        return maxrss
+    return maxrss * 1024
+
+
+# --- checkpoint ---
+_checkpoint_schema = """
+CREATE TABLE IF NOT EXISTS record (
+    record_key BLOB PRIMARY KEY,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS pair (
+    record_key BLOB,
+    key BLOB,
+    list_of_values BLOB
+);
+CREATE INDEX IF NOT EXISTS pair_record_key ON pair (record_key);
+CREATE INDEX IF NOT EXISTS pair_key ON pair (key);
+CREATE TABLE IF NOT EXISTS dirty (
+    key BLOB PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS output (
+    key BLOB PRIMARY KEY,
+    emitted BLOB
+);
+"""
+
+
+def _dumps(obj):
+    """Serialize for the checkpoint, a fixed protocol keeps keys stable
+    between runs.
+    """
+    return pickle.dumps(obj, 2)
+
+
+# --- distributter sources ---
+_whitespaces = (" ", "\n", "\t", "\r")
+_byte_whitespaces = (b" ", b"\n", b"\t", b"\r")
+
+
+def iter_text_file(path, chunk_size=1024 * 1024, encoding="utf-8",
+                   use_mmap=False):
+    """Lazily yield ``(path, content)`` records from a large text file.
+    ``content`` is about ``chunk_size`` long and always ends at a whitespace,
+    so a word is never split between two records.
+
+    :param use_mmap: memory-map the file and yield ``bytes`` content sliced
+      from the mapping, the file is paged in by the OS and never decoded to
+      Python strings.
+    """
+    if use_mmap:
+        for record in _iter_mmap_file(path, chunk_size):
+            yield record
+        return
+
+    with io.open(path, "r", encoding=encoding) as f:
+        tail = ""
+        while 1:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                if tail:
+                    yield path, tail
+                break
+            chunk = tail + chunk
+            cut = max([chunk.rfind(c) for c in _whitespaces])
+            if cut == -1:
+                tail = chunk
+                continue
+            tail = chunk[cut + 1:]
+            yield path, chunk[:cut + 1]
+
+
+def _iter_mmap_file(path, chunk_size):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = len(mm)
+            start = 0
+            while start < size:
+                end = start + chunk_size
+                if end >= size:
+                    end = size
+                else:
+                    cut = max([mm.rfind(c, start, end)
+                               for c in _byte_whitespaces])
+                    if cut == -1:  # a word longer than chunk_size
+                        cut = min([i for i in [mm.find(c, end)
+                                               for c in _byte_whitespaces]
+                                   if i != -1] or [size - 1])
+                    end = cut + 1
+                yield path, mm[start:end]
+                start = end
+        finally:
+            mm.close()
+
+
+def iter_text_dir(dir_path, pattern="*.txt", **kwargs):
+    """Lazily yield ``(path, content)`` records from all text files matching
+    ``pattern`` in a directory, in file name order. ``kwargs`` are passed
+    to :func:`iter_text_file`.
+    """
+    for path in sorted(glob.glob(os.path.join(dir_path, pattern))):
+        for record in iter_text_file(path, **kwargs):
+            yield record
+
+
+def iter_jsonl(path, encoding="utf-8"):
+    """Lazily yield one record per line from a JSON Lines file.
+    """
+    with io.open(path, "r", encoding=encoding) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def test_iter_text_file():
+    texts = [
+        "",
+        "   ",
+        "a",
+        "a bb ccc\tdddd\n\neeeee ",
+        " supercalifragilistic is  longer\tthan\nany chunk_size",
+        "caf\u00e9 na\u00efve \u00fcber caf\u00e9\n",
+    ]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "text.txt")
+        for text in texts:
+            with io.open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+            expected = Counter(text.split())
+            for chunk_size in range(1, 9):
+                for use_mmap in [False, True]:
+                    counter = Counter()
+                    for record_path, content in iter_text_file(
+                            path, chunk_size=chunk_size, use_mmap=use_mmap):
+                        assert record_path == path
+                        if use_mmap:
+                            content = content.decode("utf-8")
+                        counter.update(content.split())
+                    assert counter == expected, (text, chunk_size, use_mmap)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+test_iter_text_file()
 
 
 class MapReduce(object):
 
+    combiner = None  # optional method, pre-aggregate values on the map side
+    batch_size = 1000  # number of records mapped between two combiner runs
+    memory_budget = None  # max number of intermediate values kept in memory
+    spill_dir = None  # where to spill intermediate, default is system temp
+    profile = False  # run cProfile during execute, stats go into report
+    trace_memory = False  # measure peak memory with tracemalloc (slow)
+    n_largest_key = 10  # how many largest key groups are reported, 0 to skip
+
     def __init__(self):
-        self.intermediate = dict()
+        self.intermediate = defaultdict(list)
         self.result = list()
+        self.report = None
+        self._intermediate_report = None
+        self._n_values = 0
+        self._emit_counts = dict()  # values emitted per combined key
+        self._runs = list()
+        self._phase_time = dict()
+        self._phase_stack = list()
 
     def emit_intermediate(self, key, value):
         """A method storing result from each worker into intermediate.
         """
-        try:
-            self.intermediate[key].append(value)
-        except:
-            self.intermediate[key] = [value, ]
+        self.intermediate[key].append(value)
+
+    def emit_intermediate_many(self, pairs):
+        """Store many ``(key, value)`` pairs into intermediate, cheaper than
+        calling :meth:`emit_intermediate` for each pair.
+        """
+        intermediate = self.intermediate
+        for key, value in pairs:
+            intermediate[key].append(value)
 
     def emit(self, value):
         """A method generate the final output.
         """
         self.result.append(value)
 
-    def execute(self):
+    def execute(self, processes=None, chunksize=100):
         """Execute Map Reduce.
+
+        :param processes: number of worker processes. By default everything
+          runs in the current process.
+        :param chunksize: how many records are sent to a map worker at a time.
+
+        A report of the run is stored in ``report``, see :meth:`_make_report`.
+        """
+        self._phase_time = dict()
+        self._phase_stack = list()
+        self._emit_counts = dict()
+        profiler = cProfile.Profile() if self.profile else None
+        start_tracemalloc = self.trace_memory and not tracemalloc.is_tracing()
+        if start_tracemalloc:
+            tracemalloc.start()
+        if profiler is not None:
+            profiler.enable()
+
+        st = perf_counter()
+        records = _TimedIterator(self.distributter())
+        try:
+            if processes:
+                self._execute_parallel(records, processes, chunksize)
+            else:
+                with self._timed("map"):
+                    self._map(records)
+                # distributter runs inside the map loop
+                self._phase_time["map"] -= records.elapsed
+                self._intermediate_report = self._intermediate_stats()
+                with self._timed("reduce"):
+                    self._reduce()
+            self._phase_time["distribute"] = records.elapsed
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            peak_memory = None
+            if self.trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+            if start_tracemalloc:
+                tracemalloc.stop()
+
+        self.report = self._make_report(
+            total=perf_counter() - st,
+            n_record=records.count,
+            peak_memory=peak_memory,
+            profiler=profiler,
+        )
+
+    @contextmanager
+    def _timed(self, phase):
+        """Add the wall time of the block to ``phase``, excluding the time of
+        the nested ``_timed`` blocks.
+        """
+        self._phase_stack.append(0.0)
+        st = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - st
+            nested = self._phase_stack.pop()
+            self._phase_time[phase] = \
+                self._phase_time.get(phase, 0.0) + elapsed - nested
+            if self._phase_stack:
+                self._phase_stack[-1] += elapsed
+
+    def _intermediate_stats(self):
+        """Size of intermediate at the end of the map phase. If intermediate
+        has been spilled, key and value counts only cover the part still in
+        memory.
+
+        ``largest_keys`` ranks keys by the number of values emitted by
+        ``mapper``, counted before ``combiner`` runs, so it shows key skew
+        even when values are combined. If intermediate has been spilled, the
+        counts are stored in the runs and ``largest_keys`` is filled during
+        the merge of the reduce phase.
+        """
+        n_value = sum([len(v) for v in self.intermediate.values()])
+        if self._runs:
+            largest_keys = None
+        elif self.combiner is None:  # intermediate holds every emitted value
+            largest_keys = heapq.nlargest(
+                self.n_largest_key,
+                [(key, len(v)) for key, v in self.intermediate.items()],
+                key=itemgetter(1))
+        else:
+            largest_keys = heapq.nlargest(
+                self.n_largest_key, self._emit_counts.items(),
+                key=itemgetter(1))
+        spilled_nbytes = 0
+        for f in self._runs:
+            f.seek(0, os.SEEK_END)
+            spilled_nbytes += f.tell()
+
+        stats = OrderedDict()
+        stats["n_key"] = len(self.intermediate)
+        stats["n_value"] = n_value
+        stats["nbytes"] = _approx_nbytes(self.intermediate, n_value)
+        stats["n_spilled_run"] = len(self._runs)
+        stats["spilled_nbytes"] = spilled_nbytes
+        stats["largest_keys"] = largest_keys
+        return stats
+
+    def _make_report(self, total, n_record, peak_memory, profiler):
+        """Build the structured report of the last :meth:`execute`::
+
+            {
+                "total": wall time in seconds,
+                "phases": {"distribute": ..., "map": ..., "shuffle": ...,
+                           "reduce": ...},
+                "n_record": ...,
+                "records_per_sec": ...,
+                "intermediate": {"n_key": ..., "n_value": ..., "nbytes": ...,
+                                 "n_spilled_run": ..., "spilled_nbytes": ...,
+                                 "largest_keys": [(key, n_emitted), ...]},
+                "peak_memory": bytes,
+                "peak_memory_source": "tracemalloc" or "maxrss",
+                "profile": cProfile stats text or None,
+            }
+
+        In parallel mode, ``distribute`` overlaps with ``map`` and workers
+        are not profiled.
+        """
+        report = OrderedDict()
+        report["total"] = total
+        report["phases"] = OrderedDict([
+            (phase, self._phase_time.get(phase, 0.0))
+            for phase in ["distribute", "map", "shuffle", "reduce"]
+        ])
+        report["n_record"] = n_record
+        report["records_per_sec"] = n_record / total if total else None
+        report["intermediate"] = self._intermediate_report
+        if peak_memory is None:
+            report["peak_memory"] = _peak_rss()
+            report["peak_memory_source"] = "maxrss"
+        else:
+            report["peak_memory"] = peak_memory
+            report["peak_memory_source"] = "tracemalloc"
+        if profiler is None:
+            report["profile"] = None
+        else:
+            stream = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stream)
+            stats.sort_stats("cumulative").print_stats(20)
+            report["profile"] = stream.getvalue()
+        return report
+
+    def _map(self, records):
+        """Run ``mapper`` on each record.
+
+        If ``combiner(key, list_of_values)`` is defined, values emitted by
+        every ``batch_size`` records are combined into intermediate, so
+        intermediate grows with the number of distinct keys instead of the
+        number of emitted values. ``combiner`` returns a shorter list of values
+        which gives the same output when passed to ``reducer``, it may be
+        called many times on the same key. Each merge calls ``combiner`` once
+        per key, a small ``batch_size`` makes it slower than not combining.
+
+        If ``memory_budget`` is defined, intermediate is spilled to disk as a
+        sorted run whenever it holds more values than the budget.
+        """
+        if self.combiner is None and self.memory_budget is None:
+            for record in records:
+                self.mapper(record)
+            return
+
+        store = self.intermediate
+        try:
+            for chunk in grouper(records, self.batch_size):
+                self.intermediate = defaultdict(list)
+                for record in chunk:
+                    self.mapper(record)
+                with self._timed("shuffle"):
+                    self._n_values += self._merge_into(
+                        store, self.intermediate)
+                    self._check_memory_budget(store)
+        finally:
+            self.intermediate = store
+
+    def _merge_into(self, store, intermediate, emit_counts=None):
+        """Merge ``intermediate`` into ``store``, apply ``combiner`` on each
+        key if defined. Return the number of values added to ``store``.
+
+        When values are combined, the number of values emitted per key of
+        ``store`` is kept in ``_emit_counts``, unless ``n_largest_key`` is 0.
+        ``emit_counts`` gives it when ``intermediate`` has already been
+        combined, by default it's the length of each list.
+        """
+        n = 0
+        combiner = self.combiner
+        counts = self._emit_counts if self.n_largest_key else None
+        for key, list_of_values in intermediate.items():
+            if counts is not None:
+                if emit_counts is None:
+                    n_emitted = len(list_of_values)
+                else:
+                    n_emitted = emit_counts[key]
+                counts[key] = counts.get(key, 0) + n_emitted
+            if key in store:
+                old_values = store[key]
+                if combiner is None:
+                    old_values.extend(list_of_values)
+                    n += len(list_of_values)
+                    continue
+                n -= len(old_values)
+                list_of_values = old_values + list_of_values
+            if combiner is not None:
+                list_of_values = list(combiner(key, list_of_values))
+            store[key] = list_of_values
+            n += len(list_of_values)
+        return n
+
+    def _check_memory_budget(self, store):
+        """Spill ``store`` to disk if it exceeds ``memory_budget``.
+        """
+        if self.memory_budget is not None \
+                and self._n_values > self.memory_budget:
+            self._spill(store)
+
+    def _spill(self, store):
+        """Write ``store`` to a temp file as a run of
+        ``(key, n_emitted, list_of_values)`` sorted by key, then clear it.
+        Keys have to be sortable.
+        """
+        if self.combiner is None:
+            items = [
+                (key, len(list_of_values), list_of_values)
+                for key, list_of_values in store.items()
+            ]
+        else:
+            counts = self._emit_counts
+            items = [
+                (key, counts.get(key, 0), list_of_values)
+                for key, list_of_values in store.items()
+            ]
+        items.sort(key=itemgetter(0))
+        self._runs.append(_write_run(items, dir=self.spill_dir))
+        store.clear()
+        self._emit_counts = dict()
+        self._n_values = 0
+
+    def _reduce(self):
+        """Run ``reducer`` on each key of intermediate.
+
+        If intermediate has been spilled, the runs are k-way merged and
+        ``reducer`` receives the values as an iterator in key order, the
+        ``largest_keys`` of the report are ranked along the merge.
+        """
+        if not self._runs:
+            for key, value in self.intermediate.items():
+                self.reducer(key, value)
+            return
+
+        try:
+            if self.intermediate:
+                with self._timed("shuffle"):
+                    self._spill(self.intermediate)
+            largest_keys = None
+            if self.n_largest_key and self._intermediate_report is not None:
+                largest_keys = TopK(self.n_largest_key, key=itemgetter(1))
+            for key, values in _merge_runs(self._runs, largest_keys):
+                self.reducer(key, values)
+            if largest_keys is not None:
+                self._intermediate_report["largest_keys"] = list(largest_keys)
+        finally:
+            for f in self._runs:
+                f.close()
+            self._runs = list()
+
+    def _execute_parallel(self, records, processes, chunksize):
+        """Execute Map Reduce in a process pool.
+
+        1. records from ``distributter()`` are sent to map workers in chunks,
+           partial intermediate are merged in the order of the chunks.
+        2. intermediate keys are hash-partitioned between reduce workers.
+        3. emitted values are collected in the order of the intermediate keys,
+           so the ``result`` is the same as the serial path.
+
+        Map workers never spill, the ``memory_budget`` is applied when partial
+        intermediate are merged. If anything has been spilled, the reduce
+        phase streams the runs in the current process.
+        """
+        job = copy.copy(self)
+        job.intermediate = defaultdict(list)
+        job.result = list()
+        job.memory_budget = None
+        job._n_values = 0
+        job._emit_counts = dict()
+        job._runs = list()
+
+        pool = Pool(processes, initializer=_init_worker, initargs=(job,))
+        try:
+            chunks = grouper(records, chunksize)
+            with self._timed("map"):
+                for partial, emit_counts in pool.imap(_map_worker, chunks):
+                    with self._timed("shuffle"):
+                        self._n_values += self._merge_into(
+                            self.intermediate, partial, emit_counts)
+                        self._check_memory_budget(self.intermediate)
+            self._intermediate_report = self._intermediate_stats()
+
+            if self._runs:
+                with self._timed("reduce"):
+                    return self._reduce()
+
+            with self._timed("shuffle"):
+                partitions = [list() for _ in range(processes)]
+                for key, list_of_values in self.intermediate.items():
+                    partitions[hash(key) % processes].append(
+                        (key, list_of_values))
+            with self._timed("reduce"):
+                outputs = pool.map(_reduce_worker, partitions)
+        finally:
+            pool.close()
+            pool.join()
+
+        with self._timed("reduce"):
+            emitted = dict()
+            for output in outputs:
+                emitted.update(output)
+            for key in self.intermediate:
+                self.result.extend(emitted[key])
+
+    def record_key(self, record):
+        """Identify a record between incremental runs, default is its
+        fingerprint, so a changed record is seen as removed and added.
+
+        Records sharing a ``record_key`` are kept only once by
+        :meth:`execute_incremental`. With the default key, identical
+        duplicate records are counted once, unlike :meth:`execute`; override
+        it with a unique key, such as a title or a position, to count them
+        all.
+        """
+        return self.fingerprint(record)
+
+    def fingerprint(self, record):
+        """Tell whether a record has changed since the last incremental run.
+        """
+        return hashlib.sha1(_dumps(record)).hexdigest()
+
+    def execute_incremental(self, checkpoint_path):
+        """Execute Map Reduce, reuse the work persisted in a SQLite
+        checkpoint by the previous runs.
+
+        1. map output is persisted per record, only records with a new
+           ``record_key`` or a new ``fingerprint`` are mapped.
+        2. keys emitted by added, changed or removed records are marked dirty,
+           only dirty keys are reduced again.
+        3. progress is committed every ``batch_size`` records or keys, a
+           crashed job resumes from its last commit.
+
+        ``result`` is rebuilt from all persisted reducer output, its order
+        may differ from :meth:`execute`. Duplicate records are counted once,
+        see :meth:`record_key`. Return a summary of the work done.
+        """
+        conn = sqlite3.connect(checkpoint_path)
+        try:
+            conn.executescript(_checkpoint_schema)
+            n_record, n_mapped, n_removed = self._map_incremental(conn)
+            n_reduced = self._reduce_incremental(conn)
+            for (emitted, ) in conn.execute(
+                    "SELECT emitted FROM output ORDER BY rowid"):
+                self.result.extend(pickle.loads(emitted))
+        finally:
+            conn.close()
+
+        summary = OrderedDict()
+        summary["n_record"] = n_record
+        summary["n_mapped"] = n_mapped
+        summary["n_removed"] = n_removed
+        summary["n_reduced"] = n_reduced
+        return summary
+
+    def _map_incremental(self, conn):
+        seen = set()
+        n_mapped = 0
+        for chunk in grouper(self.distributter(), self.batch_size):
+            with conn:
+                for record in chunk:
+                    record_key = _dumps(self.record_key(record))
+                    seen.add(record_key)
+                    fingerprint = self.fingerprint(record)
+                    row = conn.execute(
+                        "SELECT fingerprint FROM record WHERE record_key = ?",
+                        (record_key, )).fetchone()
+                    if row is not None:
+                        if row[0] == fingerprint:
+                            continue
+                        self._forget_record(conn, record_key)
+
+                    rows = [
+                        (record_key, _dumps(key), _dumps(list_of_values))
+                        for key, list_of_values in self._map_one(record)
+                    ]
+                    conn.executemany("INSERT INTO pair VALUES (?, ?, ?)", rows)
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO dirty VALUES (?)",
+                        [(row[1], ) for row in rows])
+                    conn.execute(
+                        "INSERT OR REPLACE INTO record VALUES (?, ?)",
+                        (record_key, fingerprint))
+                    n_mapped += 1
+
+        removed = [
+            record_key
+            for (record_key, ) in conn.execute("SELECT record_key FROM record")
+            if bytes(record_key) not in seen
+        ]
+        with conn:
+            for record_key in removed:
+                self._forget_record(conn, record_key)
+                conn.execute(
+                    "DELETE FROM record WHERE record_key = ?", (record_key, ))
+        return len(seen), n_mapped, len(removed)
+
+    def _map_one(self, record):
+        """Map a single record, return its ``(key, list_of_values)``.
         """
-        for record in self.distributter():
+        store = self.intermediate
+        self.intermediate = defaultdict(list)
+        try:
             self.mapper(record)
+            emitted = self.intermediate
+        finally:
+            self.intermediate = store
+        if self.combiner is None:
+            return list(emitted.items())
+        return [
+            (key, list(self.combiner(key, list_of_values)))
+            for key, list_of_values in emitted.items()
+        ]
 
-        for key, value in self.intermediate.items():
-            self.reducer(key, value)
+    def _forget_record(self, conn, record_key):
+        """Drop the map output of a record, mark its keys dirty.
+        """
+        conn.execute(
+            "INSERT OR IGNORE INTO dirty "
+            "SELECT key FROM pair WHERE record_key = ?", (record_key, ))
+        conn.execute("DELETE FROM pair WHERE record_key = ?", (record_key, ))
+
+    def _reduce_incremental(self, conn):
+        dirty = [key for (key, ) in conn.execute("SELECT key FROM dirty")]
+        result = self.result
+        try:
+            for chunk in grouper(dirty, self.batch_size):
+                with conn:
+                    for key in chunk:
+                        list_of_values = list()
+                        for (values, ) in conn.execute(
+                                "SELECT list_of_values FROM pair "
+                                "WHERE key = ? ORDER BY rowid", (key, )):
+                            list_of_values.extend(pickle.loads(values))
+                        if list_of_values:
+                            self.result = list()
+                            self.reducer(pickle.loads(key), list_of_values)
+                            conn.execute(
+                                "INSERT OR REPLACE INTO output VALUES (?, ?)",
+                                (key, _dumps(self.result)))
+                        else:  # no record emits this key anymore
+                            conn.execute(
+                                "DELETE FROM output WHERE key = ?", (key, ))
+                        conn.execute("DELETE FROM dirty WHERE key = ?", (key, ))
+        finally:
+            self.result = result
+        return len(dirty)
 
     def display(self):
         """Display result.
         """
-        pprint(self.result)
+        pprint(list(self.result))
 
     def distributter(self, *args, **kwargs):
         """a generator method yield record.
@@ -123,15 +1038,31 @@ data = [
 ]
 
 
+def count_words(records):
+    """Count words of a chunk of ``(book_title, content)`` records with
+    ``collections.Counter``, which counts at C level in first-seen order.
+    """
+    counter = Counter()
+    for record in records:
+        counter.update(record[1].split())
+    return counter
+
+
 class WordCount(MapReduce):
 
     def distributter(self):
         return iter(data)
 
+    def record_key(self, record):
+        return record[0]  # book title
+
     def mapper(self, record):
         words = record[1].split()
-        for w in words:
-            self.emit_intermediate(w, 1)  # emit 1
+        self.emit_intermediate_many(zip(words, repeat(1)))  # emit 1
+
+    def combiner(self, key, list_of_values):
+        # partial word count
+        return [sum(list_of_values), ]
 
     def reducer(self, key, list_of_values):
         # key: word
@@ -141,6 +1072,122 @@ class WordCount(MapReduce):
             total += value  # counter + 1
         self.emit((key, total))
 
+    def execute_bulk(self, processes=None, chunksize=1000):
+        """Count words chunk by chunk without emitting each word. Gives the
+        same ``result`` as :meth:`execute`, only about 1.3 - 1.5 times faster:
+        1.84 -> 1.22 sec and 1.11 -> 0.75 sec in two runs of
+        ``map_reduce_benchmark.benchmark_execute_bulk`` (31.6 MB, one
+        process). Splitting and counting the words remain, at about equal
+        cost.
+
+        Worker processes don't help on one cpu, measured by the same
+        benchmark on a 1 cpu machine: 0.83 sec in process, 0.86 - 0.97 sec
+        with 1, 2 or 4 workers and ``chunksize=1000``, 1.35 - 1.65 sec with
+        ``chunksize=100``, where sending small chunks dominates. Records are
+        pickled to the workers and partial counts merged in this process, so
+        more workers can only divide the counting part, by at most the
+        number of cpu. The several times faster target is not met.
+
+        :param processes: number of worker processes counting chunks, partial
+          counts are merged in the order of the chunks.
+        :param chunksize: how many records are counted at a time.
+        """
+        if processes:
+            pool = Pool(processes)
+            try:
+                total = Counter()
+                chunks = grouper(self.distributter(), chunksize)
+                for counter in pool.imap(count_words, chunks):
+                    total.update(counter)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            total = count_words(self.distributter())
+        self.result.extend(total.items())
+
+
+def test_intermediate_stats():
+    counter = Counter()
+    for _, content in data:
+        counter.update(content.split())
+    expected = counter.most_common(3)
+
+    for combiner, memory_budget in [
+        (WordCount.combiner, None),
+        (None, None),
+        (WordCount.combiner, 50),
+    ]:
+        wc = type("WC", (WordCount, ), {"combiner": combiner})()
+        wc.memory_budget = memory_budget
+        wc.execute()
+        assert wc.report["intermediate"]["largest_keys"][:3] == expected
+
+    # emit counts are spilled with intermediate, never kept for every key
+    class BoundedWordCount(WordCount):
+        memory_budget = 50
+        batch_size = 1
+
+        def _check_memory_budget(self, store):
+            super(BoundedWordCount, self)._check_memory_budget(store)
+            assert set(self._emit_counts) <= set(store)
+            self.max_counted = max(self.max_counted, len(self._emit_counts))
+
+    wc = BoundedWordCount()
+    wc.max_counted = 0
+    wc.execute()
+    assert wc.report["intermediate"]["n_spilled_run"] > 1
+    assert wc.max_counted < len(counter) / 2
+    assert wc.report["intermediate"]["largest_keys"][:3] == expected
+
+test_intermediate_stats()
+
+
+def test_execute_incremental():
+    class IncrementalWordCount(WordCount):
+        def distributter(self):
+            return iter(self.records)
+
+    def run(records, checkpoint_path=None, klass=IncrementalWordCount):
+        wc = klass()
+        wc.records = [list(record) for record in records]
+        if checkpoint_path is None:
+            wc.execute()
+            return sorted(wc.result), None
+        summary = wc.execute_incremental(checkpoint_path)
+        return sorted(wc.result), summary
+
+    tmp_dir = tempfile.mkdtemp()
+    checkpoint_path = os.path.join(tmp_dir, "checkpoint.sqlite")
+    try:
+        records = [list(record) for record in data[:6]]
+        result, summary = run(records, checkpoint_path)
+        assert result == run(records)[0]
+        assert summary["n_mapped"] == 6
+
+        records.append(list(data[6]))  # add
+        records[0][1] += " Paradise Lost"  # change
+        del records[3]  # remove
+        result, summary = run(records, checkpoint_path)
+        assert result == run(records)[0]
+        assert (summary["n_record"], summary["n_mapped"],
+                summary["n_removed"]) == (6, 2, 1)
+
+        result, summary = run(records, checkpoint_path)
+        assert result == run(records)[0]
+        assert (summary["n_mapped"], summary["n_reduced"]) == (0, 0)
+
+        # default record_key counts identical duplicate records once
+        klass = type("WC", (IncrementalWordCount, ),
+                     {"record_key": MapReduce.record_key})
+        os.remove(checkpoint_path)
+        result, _ = run(data[:1] * 2, checkpoint_path, klass)
+        assert result == run(data[:1])[0] != run(data[:1] * 2)[0]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+test_execute_incremental()
+
 
 if __name__ == "__main__":
     wc = WordCount()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for short_url_system.py
+"""
+
+from __future__ import print_function
+import os
+import re
+import time
+import bisect
+import random
+import string
+import shutil
+import tempfile
+import tracemalloc
+
+from short_url_system import (
+    BaseShortUrlService, BaseNCodec, SQLiteStorage,
+    int_to_surfix, surfix_to_int, np,
+)
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+class BenchmarkShortUrlService(BaseShortUrlService):
+    domain = "https://goo.gl/"
+    charset = string.ascii_letters + string.digits
+    url_length = 6
+
+
+class RegexParseShortUrlService(BenchmarkShortUrlService):
+    """``parse`` with the original regex validation and string replace.
+    """
+
+    def __init__(self, storage=None):
+        super(RegexParseShortUrlService, self).__init__(storage)
+        pattern = "%s[%s]{%s}" % (self.domain, self.charset, self.url_length)
+        self.valid_pattern = re.compile(pattern)
+
+    def parse(self, short_url):
+        self.expire()
+        if re.match(self.valid_pattern, short_url) is not None:
+            surfix = short_url.replace(self.domain, "")
+            url = self.storage.get_url(surfix_to_int(surfix, self.charset))
+            if url is not None:
+                return url
+            else:
+                raise ValueError("There's no match.")
+        else:
+            raise ValueError("It's not a valid short url.")
+
+
+def make_urls(n):
+    return ["https://www.example.com/page/%s" % i for i in range(n)]
+
+
+def benchmark_many(n=200000):
+    """Compare per-url cost of ``get`` / ``parse`` loops with ``get_many`` /
+    ``parse_many``.
+    """
+    urls = make_urls(n)
+    print("--- bulk api, %s urls ---" % n)
+
+    service = BenchmarkShortUrlService()
+    st = time.time()
+    short_urls = [service.get(url) for url in urls]
+    elapsed = time.time() - st
+    print("get loop: %.3f us / url" % (elapsed / n * 1000000))
+
+    st = time.time()
+    for short_url in short_urls:
+        service.parse(short_url)
+    elapsed = time.time() - st
+    print("parse loop: %.3f us / url" % (elapsed / n * 1000000))
+
+    service = BenchmarkShortUrlService()
+    st = time.time()
+    short_urls = service.get_many(urls)
+    elapsed = time.time() - st
+    print("get_many: %.3f us / url" % (elapsed / n * 1000000))
+
+    st = time.time()
+    assert service.parse_many(short_urls) == urls
+    elapsed = time.time() - st
+    print("parse_many: %.3f us / url" % (elapsed / n * 1000000))
+
+
+def zipf_traffic(items, n_request, s=1.1, seed=0):
+    """Draw ``n_request`` items, the k-th item has probability proportional
+    to ``1 / k ** s``.
+    """
+    cum_weights = list()
+    total = 0.0
+    for k in range(1, len(items) + 1):
+        total += 1.0 / k ** s
+        cum_weights.append(total)
+    rnd = random.Random(seed)
+    return [
+        items[bisect.bisect(cum_weights, rnd.random() * total)]
+        for _ in range(n_request)
+    ]
+
+
+def percentile(sorted_timing, p):
+    return sorted_timing[min(len(sorted_timing) - 1,
+                             int(len(sorted_timing) * p / 100.0))]
+
+
+def replay(func, requests):
+    """Call ``func`` on each request, return throughput and latency
+    percentiles.
+    """
+    timing = list()
+    append = timing.append
+    st = timer()
+    for request in requests:
+        t = timer()
+        func(request)
+        append(timer() - t)
+    elapsed = timer() - st
+    timing.sort()
+    return "%.0f req / sec, p50 %.1f us, p99 %.1f us" % (
+        len(requests) / elapsed,
+        percentile(timing, 50) * 1000000,
+        percentile(timing, 99) * 1000000,
+    )
+
+
+def benchmark_zipf_load(n_url=100000, n_request=200000,
+                        cache_sizes=(0, 1000, 10000)):
+    """Replay Zipf distributed ``get`` and ``parse`` traffic against a
+    service on :class:`SQLiteStorage`, with and without the LRU cache.
+    """
+    urls = make_urls(n_url)
+    print("--- zipf load, %s urls, %s requests, sqlite storage ---" % (
+        n_url, n_request))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for cache_size in cache_sizes:
+            klass = type("CachedShortUrlService", (BenchmarkShortUrlService, ),
+                         {"cache_size": cache_size})
+            storage = SQLiteStorage(
+                os.path.join(tmp_dir, "%s.sqlite" % cache_size))
+            service = klass(storage)
+            short_urls = service.get_many(urls)
+
+            parse_requests = zipf_traffic(short_urls, n_request)
+            get_requests = zipf_traffic(urls, n_request, seed=1)
+            print("cache_size = %s" % cache_size)
+            print("  parse: %s" % replay(service.parse, parse_requests))
+            print("  get: %s" % replay(service.get, get_requests))
+            if cache_size:
+                print("  parse cache: %s" % service.parse_cache.stats())
+                print("  get cache: %s" % service.get_cache.stats())
+            storage.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchmark_memory(n=200000, ttls=(None, 30 * 3600 * 24)):
+    """Measure :class:`MemoryStorage` bytes per mapping with tracemalloc, url
+    strings excluded. Counter mode keeps urls in a list indexed by slot, hash
+    mode in a dict, like the original two dict.
+    """
+    urls = make_urls(n)
+    print("--- memory, %s urls, MemoryStorage ---" % n)
+
+    for ttl in ttls:
+        n_bytes = dict()
+        for hash_surfix in [True, False]:
+            klass = type("TTLShortUrlService", (BenchmarkShortUrlService, ),
+                         {"ttl": ttl, "hash_surfix": hash_surfix})
+            tracemalloc.start()
+            service = klass()
+            for url in urls:
+                service.get(url)
+            n_bytes[hash_surfix] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del service
+        print("ttl = %s: hash mode %.0f, counter mode %.0f bytes / mapping, "
+              "%.0f%% saved" % (
+                  ttl, n_bytes[True] / float(n), n_bytes[False] / float(n),
+                  100.0 * (1 - n_bytes[False] / float(n_bytes[True]))))
+
+
+def benchmark_parse_latency(n=100000, repeat=5):
+    """Compare the per call latency of the regex ``parse`` and the prefix
+    slicing ``parse``.
+    """
+    urls = make_urls(n)
+    print("--- parse latency, %s urls ---" % n)
+
+    for klass in [RegexParseShortUrlService, BenchmarkShortUrlService]:
+        service = klass()
+        short_urls = service.get_many(urls)
+        parse = service.parse
+        timing = list()
+        for _ in range(repeat):
+            st = time.time()
+            for short_url in short_urls:
+                parse(short_url)
+            timing.append(time.time() - st)
+        print("%s: %.3f us / call" % (
+            klass.__name__, min(timing) / n * 1000000))
+
+
+def benchmark_codec(n=200000):
+    """Compare ``int_to_surfix`` / ``surfix_to_int`` with ``BaseNCodec``.
+    """
+    charset = BenchmarkShortUrlService.charset
+    length = BenchmarkShortUrlService.url_length
+    codec = BaseNCodec(charset, length)
+    ints = [i * 7919 % codec.capacity for i in range(n)]
+    print("--- base-N codec, %s integers ---" % n)
+
+    st = time.time()
+    surfixes = [int_to_surfix(i, charset, length) for i in ints]
+    print("int_to_surfix: %.3f us / call" % ((time.time() - st) / n * 1000000))
+
+    st = time.time()
+    assert [codec.encode(i) for i in ints] == surfixes
+    print("BaseNCodec.encode: %.3f us / call" % (
+        (time.time() - st) / n * 1000000))
+
+    st = time.time()
+    [surfix_to_int(surfix, charset) for surfix in surfixes]
+    print("surfix_to_int: %.3f us / call" % ((time.time() - st) / n * 1000000))
+
+    st = time.time()
+    assert [codec.decode(surfix) for surfix in surfixes] == ints
+    print("BaseNCodec.decode: %.3f us / call" % (
+        (time.time() - st) / n * 1000000))
+
+    if np is None:
+        return
+    array = np.array(ints, dtype=np.int64)
+    st = time.time()
+    encoded = codec.encode_array(array)
+    print("BaseNCodec.encode_array: %.3f us / item" % (
+        (time.time() - st) / n * 1000000))
+
+    st = time.time()
+    assert (codec.decode_array(encoded) == array).all()
+    print("BaseNCodec.decode_array: %.3f us / item" % (
+        (time.time() - st) / n * 1000000))
+
+
+if __name__ == "__main__":
+    benchmark_many()
+    benchmark_parse_latency()
+    benchmark_codec()
+    benchmark_zipf_load()
+    benchmark_memory()
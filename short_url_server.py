@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+asyncio HTTP front end for short_url_system.py.
+
+- ``GET /<surfix>``: 301 redirect to the original url, 404 if no match.
+- ``POST /`` with the long url as request body: 200 with the short url as
+  response body.
+
+Connections are kept alive unless the client asks to close, so a client
+pays the TCP handshake once. Requests are parsed straight from the stream
+buffer, and the fixed part of every response is prebuilt bytes.
+
+Storage calls are made in the event loop, they are fast for
+:class:`~short_url_system.MemoryStorage` and for a cached
+:class:`~short_url_system.SQLiteStorage`. The SQLite storage commits every
+new mapping before its short url is sent, and is closed on SIGTERM.
+
+Python3.7+ only. Usage::
+
+    python short_url_server.py --port 8080 --db short_url.sqlite
+"""
+
+import re
+import signal
+import argparse
+import asyncio
+import string
+
+from short_url_system import BaseShortUrlService, MemoryStorage, SQLiteStorage
+
+_reason = {
+    200: b"200 OK",
+    301: b"301 Moved Permanently",
+    400: b"400 Bad Request",
+    404: b"404 Not Found",
+    405: b"405 Method Not Allowed",
+    413: b"413 Payload Too Large",
+    501: b"501 Not Implemented",
+    503: b"503 Service Unavailable",
+}
+_connection = {
+    True: b"Connection: keep-alive\r\n\r\n",
+    False: b"Connection: close\r\n\r\n",
+}
+
+# CR, LF and other control characters would split the Location header
+_control_char = re.compile("[\x00-\x1f\x7f]")
+
+
+def parse_headers(lines):
+    """Parse ``\r\n`` separated header lines into a dict of lower case
+    name -> stripped value. Raise ``ValueError`` on a line without ``:``.
+    """
+    headers = dict()
+    for line in lines.split(b"\r\n"):
+        if not line:
+            continue
+        name, sep, value = line.partition(b":")
+        if not sep or not name or name != name.strip():
+            raise ValueError("Malformed header line: %r" % line)
+        headers[name.lower()] = value.strip()
+    return headers
+
+
+def make_response(status, body=b"", headers=b"", keep_alive=True):
+    """Build a HTTP/1.1 response, ``headers`` are ``\\r\\n`` terminated
+    lines.
+    """
+    return b"".join([
+        b"HTTP/1.1 ", _reason[status],
+        b"\r\nContent-Length: ", str(len(body)).encode("ascii"), b"\r\n",
+        headers, _connection[keep_alive], body,
+    ])
+
+
+class ShortUrlServer(object):
+    """Serve a :class:`~short_url_system.BaseShortUrlService` over HTTP.
+    """
+    max_header_size = 8192
+    max_body_size = 8192
+
+    def __init__(self, service):
+        self.service = service
+        self._connections = dict()  # writer -> handler task
+        self._not_found = make_response(404, b"There's no match.")
+        self._method_not_allowed = make_response(405)
+
+    def respond(self, method, path, body):
+        """Handle one request, return ``(status, payload)``. ``payload`` is
+        the ``Location`` header of a 301, the body of a 200, None otherwise.
+        A POST gets 400 for a body which is not a utf-8 url, 503 when all
+        short urls are in use.
+        """
+        if method == b"GET":
+            short_url = self.service.domain + path[1:].decode("latin-1")
+            try:
+                url = self.service.parse(short_url)
+            except ValueError:
+                return 404, None
+            if _control_char.search(url):  # stored before urls were checked
+                return 404, None
+            return 301, b"Location: " + url.encode("utf-8") + b"\r\n"
+        elif method == b"POST" and path == b"/":
+            try:
+                url = body.decode("utf-8").strip()
+            except UnicodeDecodeError:
+                return 400, None
+            if not url or _control_char.search(url):
+                return 400, None
+            try:
+                short_url = self.service.get(url)
+            except ValueError:  # all short url are in use
+                return 503, None
+            return 200, short_url.encode("utf-8")
+        else:
+            return 405, None
+
+    async def handle(self, reader, writer):
+        """Serve requests on one connection until the client closes it, or
+        asks to close it.
+        """
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while 1:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(make_response(400, keep_alive=False))
+                    break
+
+                request_line, _, lines = head.partition(b"\r\n")
+                try:
+                    method, path, version = request_line.split(b" ")
+                    headers = parse_headers(lines)
+                except ValueError:
+                    writer.write(make_response(400, keep_alive=False))
+                    break
+                connection = headers.get(b"connection", b"").lower()
+                if version == b"HTTP/1.1":
+                    keep_alive = connection != b"close"
+                else:
+                    keep_alive = connection == b"keep-alive"
+
+                if b"transfer-encoding" in headers:
+                    # body length unknown, can't find the next request
+                    writer.write(make_response(501, keep_alive=False))
+                    break
+
+                body = b""
+                if b"content-length" in headers:
+                    try:
+                        n = int(headers[b"content-length"])
+                        if n < 0:
+                            raise ValueError(n)
+                    except ValueError:
+                        writer.write(make_response(400, keep_alive=False))
+                        break
+                    if n > self.max_body_size:
+                        writer.write(make_response(413, keep_alive=False))
+                        break
+                    try:
+                        body = await reader.readexactly(n)
+                    except (asyncio.IncompleteReadError, ConnectionError):
+                        break
+
+                status, payload = self.respond(method, path, body)
+                if status == 301:
+                    response = make_response(
+                        301, headers=payload, keep_alive=keep_alive)
+                elif status == 200:
+                    response = make_response(
+                        200, payload, keep_alive=keep_alive)
+                elif status == 404 and keep_alive:
+                    response = self._not_found
+                elif status == 405 and keep_alive:
+                    response = self._method_not_allowed
+                else:
+                    response = make_response(status, keep_alive=keep_alive)
+                writer.write(response)
+                if not keep_alive:
+                    break
+                await writer.drain()
+        finally:
+            del self._connections[writer]
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        """Serve until SIGTERM, or until cancelled. On SIGTERM, connections
+        are closed once their pending response is sent.
+        """
+        server = await asyncio.start_server(
+            self.handle, host, port, limit=self.max_header_size)
+        stop = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+        async with server:
+            await stop.wait()
+            # handlers only wait on the socket, closing it ends them
+            tasks = list(self._connections.values())
+            for writer in list(self._connections):
+                writer.close()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def make_service(host, port, storage=None, cache_size=10000):
+    """A service whose short urls point back to this server.
+    """
+    klass = type("ShortUrlService", (BaseShortUrlService, ), {
+        "domain": "http://%s:%s/" % (host, port),
+        "charset": string.ascii_letters + string.digits,
+        "url_length": 6,
+        "cache_size": cache_size,
+    })
+    return klass(storage)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Short url HTTP server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--db", default=None,
+                        help="SQLite file, default is in memory")
+    parser.add_argument("--cache-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.db is None:
+        storage = MemoryStorage()
+    else:
+        # commit each mapping before its short url is sent to the client
+        storage = SQLiteStorage(args.db, batch_size=1)
+    service = make_service(args.host, args.port, storage, args.cache_size)
+    try:
+        asyncio.run(ShortUrlServer(service).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Localhost load test for short_url_server.py.
+
+The server runs in a subprocess. Urls are shortened with ``POST``, then
+Zipf distributed ``GET`` redirects are replayed over ``concurrency``
+keep-alive connections, reporting requests / sec and p50 / p99 / p999
+latency at each concurrency level.
+
+Python3.7+ only.
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import subprocess
+
+from short_url_benchmark import make_urls, zipf_traffic, percentile
+
+server_script = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "short_url_server.py")
+
+
+def start_server(host, port, timeout=10):
+    """Start the server in a subprocess, wait until it accepts connections.
+    """
+    process = subprocess.Popen([
+        sys.executable, server_script, "--host", host, "--port", str(port),
+    ])
+    deadline = time.time() + timeout
+    while 1:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process
+        except OSError:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError("server did not start")
+            time.sleep(0.05)
+
+
+async def read_response(reader):
+    """Read one response, return ``(status, head, body)``.
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    i = head.lower().find(b"content-length:")
+    n = int(head[i + 15:head.index(b"\r\n", i)]) if i != -1 else 0
+    body = await reader.readexactly(n) if n else b""
+    return int(head[9:12]), head, body
+
+
+async def shorten(host, port, urls):
+    """POST every url over one connection, return the short urls.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    short_urls = list()
+    try:
+        for url in urls:
+            body = url.encode("utf-8")
+            writer.write(b"POST / HTTP/1.1\r\nHost: localhost\r\n"
+                         b"Content-Length: %d\r\n\r\n%s" % (len(body), body))
+            status, _, body = await read_response(reader)
+            assert status == 200
+            short_urls.append(body.decode("utf-8"))
+    finally:
+        writer.close()
+    return short_urls
+
+
+async def load(host, port, requests, concurrency):
+    """Send ``requests`` (raw bytes) over ``concurrency`` connections, each
+    connection sends its next request after the previous response. Return
+    elapsed seconds and per request latency.
+    """
+    timing = list()
+    todo = iter(requests)
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for request in todo:
+                st = time.perf_counter()
+                writer.write(request)
+                status, _, _ = await read_response(reader)
+                timing.append(time.perf_counter() - st)
+                assert status == 301, status
+        finally:
+            writer.close()
+
+    st = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return time.perf_counter() - st, timing
+
+
+def benchmark_server(n_url=10000, n_request=50000,
+                     concurrency_levels=(1, 4, 16, 64, 256),
+                     host="127.0.0.1", port=18080):
+    """Load test the redirect path at increasing concurrency.
+    """
+    process = start_server(host, port)
+    try:
+        urls = make_urls(n_url)
+        st = time.perf_counter()
+        short_urls = asyncio.run(shorten(host, port, urls))
+        elapsed = time.perf_counter() - st
+        print("--- server, %s urls, %s requests per level ---" % (
+            n_url, n_request))
+        print("POST, 1 connection: %.0f req / sec" % (n_url / elapsed))
+
+        requests = [
+            b"GET /%s HTTP/1.1\r\nHost: localhost\r\n\r\n" % (
+                short_url.rsplit("/", 1)[1].encode("ascii"))
+            for short_url in zipf_traffic(short_urls, n_request)
+        ]
+        for concurrency in concurrency_levels:
+            elapsed, timing = asyncio.run(
+                load(host, port, requests, concurrency))
+            timing.sort()
+            print("GET, concurrency = %s: %.0f req / sec, "
+                  "p50 %.2f ms, p99 %.2f ms, p999 %.2f ms" % (
+                      concurrency, len(timing) / elapsed,
+                      percentile(timing, 50) * 1000,
+                      percentile(timing, 99) * 1000,
+                      percentile(timing, 99.9) * 1000))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    benchmark_server()
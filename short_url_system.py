@@ -9,16 +9,21 @@
 """
 
 from __future__ import print_function
-import re
+import os
 import time
 import random
+import shutil
+import tempfile
 import string
-import itertools
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict, deque
 
-try:  # for Python2
-    range = xrange
-except:
-    pass
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
 
 
 def decimal_to_other_system(n, k):
@@ -79,20 +84,705 @@ def test_int_to_surfix():
 test_int_to_surfix()
 
 
-def permutation_url_surfix(charset, url_length):
-    """Yield all possible url surfix.
+def surfix_to_int(surfix, charset):
+    """The series number of a shorten url surfix, inverse of
+    :func:`int_to_surfix`.
 
-    :param charset:
-    :param url_length:
+    :param surfix: the surfix
+    :param charset: character set
+    """
+    k = len(charset)
+    i = 0
+    for char in reversed(surfix):
+        i = i * k + charset.index(char)
+    return i
+
+
+def test_surfix_to_int():
+    charset = string.ascii_lowercase
+    for i in [0, 3, 26, 12345]:
+        assert surfix_to_int(int_to_surfix(i, charset, 6), charset) == i
+
+test_surfix_to_int()
+
+
+class BaseNCodec(object):
+    """Fast :func:`int_to_surfix` / :func:`surfix_to_int` pair for a fixed
+    charset and surfix length, round trip exactly with them for integer in
+    ``range(capacity)`` and surfix of ``length`` char.
+
+    Lookup tables cover every ``chunk``-digit string, so one ``divmod`` or
+    one dict lookup handles ``chunk`` digits at a time. ``chunk`` is chosen so
+    that tables have at most ``max_table_size`` entries.
+
+    :meth:`encode_array` and :meth:`decode_array` process whole numpy
+    arrays at once, and agree with :meth:`encode` and :meth:`decode` item by
+    item.
+    """
+
+    def __init__(self, charset, length, max_table_size=4096):
+        self.charset = charset
+        self.length = length
+        self.base = base = len(charset)
+
+        chunk = 1
+        while base ** (chunk + 1) <= max_table_size and chunk < length:
+            chunk += 1
+        self.chunk = chunk
+        self.chunk_base = base ** chunk
+        self.capacity = base ** length
+        n_chunk = (length + chunk - 1) // chunk
+        self._divisors = [self.chunk_base ** j for j in range(n_chunk)]
+        self._trim = length % chunk != 0  # last chunk is padded
+
+        # chunk value -> chunk string, little endian like int_to_surfix
+        self._encode_table = [
+            int_to_surfix(i, charset, chunk) for i in range(self.chunk_base)]
+        # string of 1 to chunk char -> value
+        self._decode_table = dict()
+        for n in range(1, chunk + 1):
+            for i in range(base ** n):
+                self._decode_table[int_to_surfix(i, charset, n)] = i
+        # start of each piece, most significant first
+        self._pieces = [
+            (start, start + chunk, base ** min(chunk, length - start))
+            for start in reversed(range(0, length, chunk))
+        ]
+
+    def encode(self, i):
+        """Integer to surfix, raise ``ValueError`` if ``i`` is not in
+        ``range(capacity)``.
+        """
+        if not 0 <= i < self.capacity:  # more digits than length
+            raise ValueError("%r is not in range(%s)." % (i, self.capacity))
+        table = self._encode_table
+        chunk_base = self.chunk_base
+        surfix = ""
+        for divisor in self._divisors:
+            surfix += table[i // divisor % chunk_base]
+        if self._trim:
+            return surfix[:self.length]
+        return surfix
+
+    def decode(self, surfix):
+        """Surfix to integer, None if a char is not in the charset or the
+        surfix is not ``length`` char long.
+        """
+        if len(surfix) != self.length:
+            return None
+        table = self._decode_table
+        i = 0
+        try:
+            for start, end, piece_base in self._pieces:
+                i = i * piece_base + table[surfix[start:end]]
+        except KeyError:
+            return None
+        return i
+
+    def _check_numpy(self):
+        if np is None:
+            raise ImportError("numpy is required for array encode / decode")
+        if self.capacity > 2 ** 63:
+            raise ValueError("surfix value doesn't fit in int64")
+
+    def encode_array(self, ints):
+        """Encode an array of integer in ``range(capacity)``, return a numpy
+        array of surfix. Raise ``ValueError`` if an integer is out of range.
+        """
+        self._check_numpy()
+        n = np.asarray(ints, dtype=np.int64)
+        if n.size and (n.min() < 0 or n.max() >= self.capacity):
+            raise ValueError("integer not in range(%s)." % self.capacity)
+        digits = np.empty((n.size, self.length), dtype=np.int64)
+        n = n.ravel().copy()
+        for j in range(self.length):
+            n, digits[:, j] = np.divmod(n, self.base)
+        chars = np.array(list(self.charset), dtype="<U1")[digits]
+        return np.ascontiguousarray(chars).view("<U%s" % self.length).ravel()
+
+    def decode_array(self, surfixes):
+        """Decode an array of surfix, return a numpy int64 array, -1 for a
+        surfix with a char not in the charset or not ``length`` char long.
+        """
+        self._check_numpy()
+        surfixes = np.asarray(surfixes, dtype=str).ravel()
+        wrong_length = np.char.str_len(surfixes) != self.length
+        # pad or cut to ``length``, wrong length surfix are masked below
+        surfixes = surfixes.astype("<U%s" % self.length)
+        codes = surfixes.view(np.uint32).reshape(-1, self.length)
+        lookup = np.full(max([ord(c) for c in self.charset]) + 2, -1, np.int64)
+        for i, c in enumerate(self.charset):
+            lookup[ord(c)] = i
+        # map code point out of the lookup table to the last entry, -1
+        digits = lookup[np.minimum(codes, len(lookup) - 1)]
+        weights = self.base ** np.arange(self.length, dtype=np.int64)
+        values = digits @ weights if len(digits) else np.zeros(0, np.int64)
+        values[(digits < 0).any(axis=1) | wrong_length] = -1
+        return values
+
+
+def test_base_n_codec():
+    for charset, length in [
+        ("ab", 5), ("abcdef0123456789", 3),
+        (string.ascii_letters + string.digits, 6),
+    ]:
+        codec = BaseNCodec(charset, length)
+        capacity = len(charset) ** length
+        for i in [0, 1, 2, capacity // 3, capacity - 1]:
+            surfix = codec.encode(i)
+            assert surfix == int_to_surfix(i, charset, length)
+            assert codec.decode(surfix) == i
+    assert codec.decode("abc-ef") is None
+    assert codec.decode("abcdefXYZ") is None
+    assert codec.decode("abc") is None
+    for i in [-1, codec.capacity]:
+        try:
+            codec.encode(i)
+            raise AssertionError("%s is out of range" % i)
+        except ValueError:
+            pass
+
+    if np is not None:
+        ints = [0, 1, 12345, codec.capacity - 1]
+        surfixes = codec.encode_array(ints)
+        assert list(surfixes) == [codec.encode(i) for i in ints]
+        assert list(codec.decode_array(surfixes)) == ints
+        assert list(codec.decode_array(
+            ["abcdef", "abcdefXYZ", "abc", "abc-ef", ""])) == \
+            [codec.decode("abcdef"), -1, -1, -1, -1]
+        assert len(codec.decode_array([])) == 0
+        for ints in [[codec.capacity], [-1]]:
+            try:
+                codec.encode_array(ints)
+                raise AssertionError("%s is out of range" % ints)
+            except ValueError:
+                pass
+
+test_base_n_codec()
+
+
+class FeistelPermutation(object):
+    """A pseudo-random bijection of ``range(n)``, computed in O(1) time and
+    memory, so ``permutation(0), permutation(1), ...`` hand out every number
+    exactly once in a shuffled order without storing the shuffle.
+
+    A balanced Feistel network permutes ``range(4 ** half_bits)``, the
+    smallest even power of 2 not less than n. Output out of ``range(n)``
+    goes through the network again (cycle walking), which takes less than 4
+    rounds on average.
+
+    :param n: size of the domain.
+    :param seed: random seed of the round keys.
+    :param rounds: number of Feistel rounds.
+    """
+
+    def __init__(self, n, seed=None, rounds=4):
+        self.n = n
+        self.half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        rnd = random.Random(seed)
+        self.keys = [rnd.getrandbits(64) for _ in range(rounds)]
+        self._reversed_key_products = [
+            (key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            for key in reversed(self.keys)
+        ]
+
+    def _round_function(self, value, key):
+        x = ((value + key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        x ^= x >> 29
+        return x & self.mask
+
+    def _encrypt(self, value):
+        left, right = value >> self.half_bits, value & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self._round_function(right, key)
+        return (left << self.half_bits) | right
+
+    def _decrypt(self, value):
+        # _round_function inlined, it runs on every storage lookup, with
+        # (value + key) * c = value * c + key * c precomputed mod 2 ** 64
+        half_bits, mask = self.half_bits, self.mask
+        left, right = value >> half_bits, value & mask
+        for key_product in self._reversed_key_products:
+            x = (left * 0x9E3779B97F4A7C15 + key_product) & 0xFFFFFFFFFFFFFFFF
+            left, right = right ^ ((x ^ (x >> 29)) & mask), left
+        return (left << half_bits) | right
+
+    def __call__(self, i):
+        value = self._encrypt(i)
+        while value >= self.n:
+            value = self._encrypt(value)
+        return value
+
+    def inverse(self, value):
+        """Find ``i`` such that ``permutation(i) == value``, in O(1).
+        """
+        i = self._decrypt(value)
+        while i >= self.n:
+            i = self._decrypt(i)
+        return i
+
+
+def test_feistel_permutation():
+    for n in [1, 2, 3, 16, 100, 1000]:
+        permutation = FeistelPermutation(n, seed=n)
+        assert sorted([permutation(i) for i in range(n)]) == list(range(n))
+        assert [permutation.inverse(permutation(i)) for i in range(n)] == \
+            list(range(n))
+
+test_feistel_permutation()
+
+
+class LRUCache(object):
+    """Bounded least recently used cache, thread safe. Counts hits, misses
+    and evictions.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return the cached value, or None.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = value  # most recently used is the last
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" is the least recently used now
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    cache.discard("c")
+    assert cache.get("c") is None
+    assert cache.stats() == {"size": 1, "hits": 2, "misses": 2, "evictions": 1}
+
+test_lru_cache()
+
+
+class MemoryStorage(object):
+    """In-memory url mapping. Mappings are keyed by the integer value of
+    the surfix, so surfix strings are never stored.
+
+    A counter mode service calls :meth:`use_slots`, then urls are kept in a
+    list indexed by counter slot instead of an ``id -> url`` dict, the
+    Feistel permutation maps an id back to its slot in O(1). Only
+    ``hash_surfix`` mode, whose ids are not counter slots, uses the dict.
+    Measured with ``benchmark_memory`` in short_url_benchmark.py, a mapping
+    takes 82 instead of 126 bytes without ttl, 122 instead of 167 bytes with
+    a ttl (url strings excluded), while the inverse permutation adds about
+    2 us to each lookup.
+
+    Mappings are queued by insertion order, with their expiry time in a
+    parallel queue. With the constant ``ttl`` of a service, expiry time grows
+    with insertion order, so expired mappings are found at the head in O(1)
+    each, without scanning. A mapping expiring before the one ahead of it
+    waits for it. Writes are thread safe.
+    """
+
+    def __init__(self):
+        self._urls = dict()  # id -> url, or slot -> url list after use_slots
+        self._slot_of = None  # id -> slot
+        self._ids = dict()  # url -> id
+        self._meta = dict()
+        self._expiry_ids = deque()  # id of mappings with an expiry time
+        self._expire_at = deque()  # their expiry time, same order
+        self._free = list()  # id of expired mappings, to reuse
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def use_slots(self, slot_of):
+        """Keep urls in a list indexed by ``slot_of(id)``, a bijection of
+        ``range(capacity)`` such as the inverse of the counter permutation.
+        Every id put afterwards has to be in ``range(capacity)``.
+        """
+        with self._lock:
+            self._slot_of = slot_of
+            self._urls = list()
+            for url, id in self._ids.items():
+                self._set_url(id, url)
+
+    def _set_url(self, id, url, slot=None):
+        """Store ``url`` at ``id``, None to delete. Return the previous url.
+        ``slot`` saves computing ``slot_of(id)`` again.
+        """
+        if self._slot_of is None:
+            if url is None:
+                return self._urls.pop(id, None)
+            old_url = self._urls.get(id)
+            self._urls[id] = url
+            return old_url
+        if slot is None:
+            slot = self._slot_of(id)
+        urls = self._urls
+        if slot >= len(urls):
+            urls.extend([None] * (slot + 1 - len(urls)))
+        old_url = urls[slot]
+        urls[slot] = url
+        return old_url
+
+    def get_id(self, url):
+        return self._ids.get(url)
+
+    def get_url(self, id):
+        if self._slot_of is None:
+            return self._urls.get(id)
+        slot = self._slot_of(id)
+        urls = self._urls
+        return urls[slot] if slot < len(urls) else None
+
+    def get_url_many(self, ids):
+        if self._slot_of is None:
+            get = self._urls.get
+            return [get(id) for id in ids]
+        get_url = self.get_url
+        return [get_url(id) for id in ids]
+
+    def put(self, id, url, expire_at=None):
+        """Map ``id`` to ``url``. Return the id ``url`` is mapped to, which is
+        not ``id`` if ``url`` is already mapped, or None if ``id`` is taken
+        by another url.
+        """
+        with self._lock:
+            return self._put(id, url, expire_at)
+
+    def _put(self, id, url, expire_at):
+        existing_id = self._ids.get(url)
+        if existing_id is not None:
+            return existing_id
+        if self._slot_of is None:
+            if id in self._urls:
+                return None
+            self._urls[id] = url
+        else:
+            slot = self._slot_of(id)
+            if slot < len(self._urls) and self._urls[slot] is not None:
+                return None
+            self._set_url(id, url, slot)
+        self._ids[url] = id
+        if expire_at is not None:
+            self._expiry_ids.append(id)
+            self._expire_at.append(expire_at)
+        return id
+
+    def put_many(self, rows):
+        """:param rows: list of ``(id, url, expire_at)``.
+
+        Return the id each url is mapped to, None where ``id`` is taken.
+        """
+        with self._lock:
+            return [self._put(id, url, expire_at)
+                    for id, url, expire_at in rows]
+
+    def pop_expired(self, now, free=True):
+        """Delete mappings expired at ``now``, make their id free unless
+        ``free`` is False. Return the deleted ``(id, url)``.
+        """
+        expired = list()
+        expire_at = self._expire_at
+        if not expire_at or expire_at[0] > now:
+            return expired
+        with self._lock:
+            while expire_at and expire_at[0] <= now:
+                expire_at.popleft()
+                id = self._expiry_ids.popleft()
+                url = self._set_url(id, None)
+                del self._ids[url]
+                if free:
+                    self._free.append(id)
+                expired.append((id, url))
+        return expired
+
+    def pop_free(self, n):
+        """Take at most ``n`` free id.
+        """
+        if not self._free:
+            return list()
+        with self._lock:
+            free = self._free[-n:] if n else list()
+            del self._free[len(self._free) - len(free):]
+        return free
+
+    def push_free(self, ids):
+        """Give back unused id.
+        """
+        with self._lock:
+            self._free.extend(ids)
+
+    def reserve(self, name, n):
+        """Atomically add ``n`` to counter ``name``, return its old value.
+        """
+        with self._lock:
+            start = self._meta.get(name, 0)
+            self._meta[name] = start + n
+        return start
+
+    def get_meta(self, name, default=None):
+        return self._meta.get(name, default)
+
+    def set_meta(self, name, value):
+        self._meta[name] = value
+
+    def setdefault_meta(self, name, value):
+        """Set ``name`` if not set yet, return the value in storage.
+        """
+        with self._lock:
+            return self._meta.setdefault(name, value)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage(object):
+    """On-disk url mapping, survives restart. Writes are committed every
+    ``batch_size`` mappings, or on :meth:`flush` / :meth:`close`.
+
+    Expired mappings are found with an index on ``expire_at``, which is only
+    queried once the earliest expiry time is reached.
 
-    When charset and url_length is large, it's very slow!
+    The connection is shared by threads behind a lock. Several processes can
+    open the same file, each with its own :class:`SQLiteStorage`. In that case
+    use ``batch_size=1``, since a pending batch holds the write lock.
     """
-    d = {i: char for i, char in enumerate(charset)}
-    charset_len = len(charset)
-    for i in range(charset_len ** url_length):
-        l = decimal_to_other_system(i, charset_len)
-        l.extend([0, ] * (url_length - len(l)))
-        yield "".join([d[ind] for ind in l])
+
+    def __init__(self, path, batch_size=1000, timeout=30):
+        self.path = path
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(
+            path, timeout=timeout, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS mapping (
+            id INTEGER PRIMARY KEY,
+            url TEXT NOT NULL UNIQUE,
+            expire_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS mapping_expire_at ON mapping (expire_at);
+        CREATE TABLE IF NOT EXISTS free (
+            id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value
+        );
+        """)
+        self._n_pending = 0
+        self._next_expire_at = self._min_expire_at()
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM mapping").fetchone()[0]
+
+    def get_id(self, url):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT id FROM mapping WHERE url = ?", (url, )).fetchone()
+        return None if row is None else row[0]
+
+    def get_url(self, id):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT url FROM mapping WHERE id = ?", (id, )).fetchone()
+        return None if row is None else row[0]
+
+    def get_url_many(self, ids, chunk_size=500):
+        urls = dict()
+        with self._lock:
+            for i in range(0, len(ids), chunk_size):
+                chunk = list(set(ids[i:i + chunk_size]))
+                sql = "SELECT id, url FROM mapping WHERE id IN (%s)" % (
+                    ", ".join(["?"] * len(chunk)))
+                urls.update(self.conn.execute(sql, chunk))
+        return [urls.get(id) for id in ids]
+
+    def put(self, id, url, expire_at=None):
+        """Map ``id`` to ``url``. Return the id ``url`` is mapped to, which is
+        not ``id`` if ``url`` has been mapped, maybe by another process, or
+        None if ``id`` is taken by another url.
+        """
+        with self._lock:
+            try:
+                self.conn.execute(
+                    "INSERT INTO mapping VALUES (?, ?, ?)",
+                    (id, url, expire_at))
+            except sqlite3.IntegrityError:
+                return self.get_id(url)
+            self._update_next_expire_at(expire_at)
+            self._n_pending += 1
+            if self._n_pending >= self.batch_size:
+                self.flush()
+        return id
+
+    def put_many(self, rows):
+        """:param rows: list of ``(id, url, expire_at)``.
+
+        Return the id each url is mapped to, None where ``id`` is taken.
+        """
+        with self._lock:
+            total_changes = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO mapping VALUES (?, ?, ?)", rows)
+            if self.conn.total_changes - total_changes == len(rows):
+                ids = [row[0] for row in rows]
+            else:  # some url have been mapped, or some id are taken
+                ids = [self.get_id(row[1]) for row in rows]
+            for row in rows:
+                self._update_next_expire_at(row[2])
+            self.flush()
+        return ids
+
+    def _min_expire_at(self):
+        return self.conn.execute(
+            "SELECT MIN(expire_at) FROM mapping").fetchone()[0]
+
+    def _update_next_expire_at(self, expire_at):
+        if expire_at is not None and (self._next_expire_at is None
+                                      or expire_at < self._next_expire_at):
+            self._next_expire_at = expire_at
+
+    def pop_expired(self, now, free=True):
+        """Delete mappings expired at ``now``, make their id free unless
+        ``free`` is False. Return the deleted ``(id, url)``.
+        """
+        if self._next_expire_at is None or now < self._next_expire_at:
+            return list()
+        with self._lock:
+            expired = self.conn.execute(
+                "SELECT id, url FROM mapping WHERE expire_at <= ?",
+                (now, )).fetchall()
+            self.conn.execute(
+                "DELETE FROM mapping WHERE expire_at <= ?", (now, ))
+            if free:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO free VALUES (?)",
+                    [(id, ) for id, _ in expired])
+            self.flush()
+            self._next_expire_at = self._min_expire_at()
+        return expired
+
+    def pop_free(self, n):
+        """Take at most ``n`` free id. An id taken by another process in the
+        meantime is skipped.
+        """
+        with self._lock:
+            free = list()
+            for (id, ) in self.conn.execute(
+                    "SELECT id FROM free LIMIT ?", (n, )).fetchall():
+                cursor = self.conn.execute(
+                    "DELETE FROM free WHERE id = ?", (id, ))
+                if cursor.rowcount == 1:
+                    free.append(id)
+        return free
+
+    def push_free(self, ids):
+        """Give back unused id.
+        """
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO free VALUES (?)", [(id, ) for id in ids])
+            self.flush()
+
+    def reserve(self, name, n):
+        """Atomically add ``n`` to counter ``name``, return its old value.
+        Processes sharing the file get disjoint ranges.
+        """
+        with self._lock:
+            self.flush()
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT value FROM meta WHERE name = ?",
+                    (name, )).fetchone()
+                start = 0 if row is None else row[0]
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    (name, start + n))
+            except BaseException:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+        return start
+
+    def use_slots(self, slot_of):
+        """Nothing to do, ids are looked up in the primary key index.
+        """
+
+    def get_meta(self, name, default=None):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE name = ?", (name, )).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, name, value):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+            self.flush()
+
+    def setdefault_meta(self, name, value):
+        """Set ``name`` if not set yet, return the value in storage.
+        """
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO meta VALUES (?, ?)", (name, value))
+            self.flush()
+            return self.get_meta(name)
+
+    def flush(self):
+        with self._lock:
+            self.conn.commit()
+            self._n_pending = 0
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self.conn.close()
 
 
 class BaseShortUrlService(object):
@@ -102,21 +792,72 @@ class BaseShortUrlService(object):
 
     1. 如果一个Url曾经出现过, 那么直接使用旧的surfix。
     2. 如果一个Url没有出现过, 那么给他发一个新surfix。
+    3. 一个Url在发出surfix的 ``ttl`` 秒后过期, 过期的surfix会被回收再利用。
+
+    :param storage: where url mappings live, default is a new
+      :class:`MemoryStorage`. The permutation seed and the allocation counter
+      are saved in the storage too, so a :class:`SQLiteStorage` service
+      carries on after restart without reissuing a surfix.
+
+    The service is thread safe: urls are hashed to ``n_lock_stripe`` locks,
+    so only threads shortening urls of the same stripe wait for each other.
+    Several processes can share one :class:`SQLiteStorage` file, each
+    process reserves blocks of ``reserve_size`` surfix from a shared
+    counter and allocates from its own block without contention.
+
+    With ``cache_size`` set, :meth:`get` and :meth:`parse` answer hot urls
+    from two :class:`LRUCache`, ``get_cache`` and ``parse_cache``, without
+    touching the storage. Cached entries are dropped when their mapping
+    expires. Caches are per service object, mappings expired by another
+    process are only dropped when this service expires them too.
+
+    With ``hash_surfix = True`` the surfix of a url is derived from a blake2b
+    hash of the url instead of the shuffled counter, see :meth:`hash_id`.
+    Services with the same ``charset`` and ``url_length`` give a url the
+    same surfix without sharing any state, as long as the hash does not
+    collide. A colliding url takes the next free surfix (linear probing),
+    which depends on what is already stored. Expired surfix are deleted and
+    not recycled, the url gets its hash surfix again next time.
     """
     domain = None  # string, example "https://goo.gl/", has to endswith "/"
     charset = None  # string
     url_length = None  # integer
-    ttl = 30 * 3600 * 24  # time to live
+    ttl = 30 * 3600 * 24  # time to live in seconds, None for forever
+    seed = None  # random seed of the surfix order, None for a random one
+    reserve_size = 1000  # number of surfix reserved in storage at a time
+    n_lock_stripe = 64  # number of locks guarding url lookup then insert
+    cache_size = 0  # number of hot url cached by get and parse, 0 to disable
+    hash_surfix = False  # derive surfix from a hash of url, instead of counter
 
-    def __init__(self):
-        surfix_permutation = list(
-            permutation_url_surfix(self.charset, self.url_length))
-        random.shuffle(surfix_permutation)
-        self.surfix_cycle = itertools.cycle(surfix_permutation)
-        self.mapper = dict()
+    def __init__(self, storage=None):
+        if storage is None:
+            storage = MemoryStorage()
+        self.storage = storage
 
-        pattern = "%s[%s]{%s}" % (self.domain, self.charset, self.url_length)
-        self.valid_pattern = re.compile(pattern)
+        seed = self.seed if self.seed is not None else random.getrandbits(62)
+        seed = storage.setdefault_meta("seed", seed)
+        self.permutation = FeistelPermutation(self.capacity, seed=seed)
+        if not self.hash_surfix:
+            storage.use_slots(self.permutation.inverse)
+        # surfix of an unused block are lost, but never reissued
+        self.counter = 0
+        self.reserved = 0
+        self._alloc_lock = threading.Lock()
+        self._url_locks = [
+            threading.Lock() for _ in range(self.n_lock_stripe)]
+
+        self._short_url_length = len(self.domain) + self.url_length
+        self.codec = BaseNCodec(self.charset, self.url_length)
+        self._charset_deletion = dict.fromkeys([ord(c) for c in self.charset])
+
+        if self.cache_size:
+            self.get_cache = LRUCache(self.cache_size)  # url -> short url
+            self.parse_cache = LRUCache(self.cache_size)  # short url -> url
+        else:
+            self.get_cache = self.parse_cache = None
+        # bumped on expiry, a lookup racing with it is not cached
+        self._n_expire = 0
+        self._cache_lock = threading.Lock()
 
     @property
     def capacity(self):
@@ -127,27 +868,412 @@ class BaseShortUrlService(object):
         """
         if url.startswith(self.domain):
             return url
-        elif url in self.mapper:
-            surfix = self.mapper[url]
-        else:
-            surfix = next(self.surfix_cycle)
-            self.mapper[surfix] = url
-            self.mapper[url] = surfix
-        short_url = self.domain + surfix
+        now = time.time()
+        self.expire(now)
+        if self.get_cache is not None:
+            short_url = self.get_cache.get(url)
+            if short_url is not None:
+                return short_url
+            n_expire = self._n_expire
+        with self._url_locks[hash(url) % self.n_lock_stripe]:
+            id = self.storage.get_id(url)
+            if id is None and self.hash_surfix:
+                id = self._put_hashed(url, self._expire_at(now))
+            elif id is None:
+                new_id = self._next_id()
+                id = self.storage.put(new_id, url, self._expire_at(now))
+                if id != new_id:  # mapped by another process
+                    self.storage.push_free([new_id, ])
+        short_url = self.domain + self.codec.encode(id)
+        if self.get_cache is not None:
+            self._cache_put(self.get_cache, n_expire, url, short_url)
         return short_url
 
+    def get_many(self, urls):
+        """Get shortened urls for many urls, in input order. Each distinct new
+        url is allocated a surfix from one block, or is hashed in
+        ``hash_surfix`` mode.
+        """
+        domain = self.domain
+        storage = self.storage
+        now = time.time()
+        self.expire(now)
+
+        stripes = sorted(set([
+            hash(url) % self.n_lock_stripe for url in urls]))
+        for stripe in stripes:
+            self._url_locks[stripe].acquire()
+        try:
+            ids = dict()
+            new_urls = list()
+            for url in urls:
+                if url in ids or url.startswith(domain):
+                    continue
+                id = storage.get_id(url)
+                if id is None:
+                    new_urls.append(url)
+                ids[url] = id
+
+            expire_at = self._expire_at(now)
+            if self.hash_surfix:
+                new_ids = [self.hash_id(url) for url in new_urls]
+                mapped_ids = storage.put_many([
+                    (id, url, expire_at) for id, url in zip(new_ids, new_urls)])
+                mapped_ids = [  # probe from the next surfix on collision
+                    self._put_hashed(url, expire_at, id + 1)
+                    if mapped_id is None else mapped_id
+                    for id, url, mapped_id in zip(new_ids, new_urls, mapped_ids)
+                ]
+            else:
+                new_ids = self._next_id_block(len(new_urls))
+                mapped_ids = storage.put_many([
+                    (id, url, expire_at) for id, url in zip(new_ids, new_urls)])
+                unused_ids = [
+                    id for id, mapped_id in zip(new_ids, mapped_ids)
+                    if id != mapped_id
+                ]
+                if unused_ids:  # mapped by another process
+                    storage.push_free(unused_ids)
+            ids.update(zip(new_urls, mapped_ids))
+        finally:
+            for stripe in stripes:
+                self._url_locks[stripe].release()
+
+        encode = self.codec.encode
+        return [
+            url if url.startswith(domain) else domain + encode(ids[url])
+            for url in urls
+        ]
+
+    def _expire_at(self, now):
+        if self.ttl is None:
+            return None
+        return now + self.ttl
+
+    def expire(self, now=None):
+        """Delete expired mappings, their surfix will be reused. It is called
+        by :meth:`get` and :meth:`parse`, and costs O(1) when nothing is due.
+        """
+        if now is None:
+            now = time.time()
+        expired = self.storage.pop_expired(now, free=not self.hash_surfix)
+        if expired and self.get_cache is not None:
+            with self._cache_lock:
+                self._n_expire += 1
+                for id, url in expired:
+                    self.get_cache.discard(url)
+                    self.parse_cache.discard(
+                        self.domain + self.codec.encode(id))
+        return expired
+
+    def _cache_put(self, cache, n_expire, key, value):
+        """Cache a lookup made when ``_n_expire`` was ``n_expire``, unless
+        mappings have expired since.
+        """
+        with self._cache_lock:
+            if self._n_expire == n_expire:
+                cache.put(key, value)
+
+    def hash_id(self, url):
+        """The first surfix integer value tried for ``url`` in
+        ``hash_surfix`` mode, it only depends on ``url`` and
+        :attr:`capacity`.
+        """
+        digest = hashlib.blake2b(url.encode("utf-8"), digest_size=8)
+        return int(digest.hexdigest(), 16) % self.capacity
+
+    def _put_hashed(self, url, expire_at, id=None):
+        """Map ``url`` to ``id``, default is :meth:`hash_id`, or the next
+        surfix not taken by another url. Return the id ``url`` is mapped to.
+        """
+        capacity = self.capacity
+        if id is None:
+            id = self.hash_id(url)
+        for _ in range(capacity):
+            id %= capacity
+            mapped_id = self.storage.put(id, url, expire_at)
+            if mapped_id is not None:
+                return mapped_id
+            id += 1
+        raise ValueError("All %s short url are in use." % capacity)
+
+    def _next_id(self):
+        """Allocate the integer value of the next surfix, in O(1) time and
+        memory. Expired surfix are reused first, then new surfix are handed
+        out in a shuffled order.
+        """
+        return self._next_id_block(1)[0]
+
+    def _next_id_block(self, n):
+        """Allocate the next ``n`` surfix integer value at once.
+        """
+        ids = self.storage.pop_free(n)
+        n -= len(ids)
+        permutation = self.permutation
+        with self._alloc_lock:
+            try:
+                while n:
+                    if self.counter >= self.reserved:
+                        self._reserve(n)
+                    m = min(n, self.reserved - self.counter)
+                    start = self.counter
+                    self.counter += m
+                    n -= m
+                    ids.extend(
+                        [permutation(i) for i in range(start, start + m)])
+            except ValueError:
+                self.storage.push_free(ids)
+                raise
+        return ids
+
+    def _reserve(self, n):
+        """Reserve a block of at least ``n`` surfix from the counter in
+        storage.
+        """
+        size = max(n, self.reserve_size)
+        start = self.storage.reserve("counter", size)
+        end = min(start + size, self.capacity)
+        if end <= start:
+            raise ValueError("All %s short url are in use." % self.capacity)
+        self.counter, self.reserved = start, end
+
     def parse(self, short_url):
         """Find the original url.
         """
-        if re.match(self.valid_pattern, short_url) is not None:
-            surfix = short_url.replace(self.domain, "")
-            if surfix in self.mapper:
-                return self.mapper[surfix]
+        self.expire()
+        if self.parse_cache is not None:
+            url = self.parse_cache.get(short_url)
+            if url is not None:
+                return url
+            n_expire = self._n_expire
+        if len(short_url) == self._short_url_length \
+                and short_url.startswith(self.domain):
+            id = self.codec.decode(short_url[len(self.domain):])
+        else:
+            id = None
+        if id is not None:
+            url = self.storage.get_url(id)
+            if url is not None:
+                if self.parse_cache is not None:
+                    self._cache_put(self.parse_cache, n_expire, short_url, url)
+                return url
             else:
                 raise ValueError("There's no match.")
         else:
             raise ValueError("It's not a valid short url.")
 
+    def parse_many(self, short_urls):
+        """Find the original urls of many short urls, in input order.
+
+        The surfix of all short urls are validated against the charset in one
+        pass. Raise ``ValueError`` for the first invalid or unknown short url.
+        """
+        self.expire()
+        domain = self.domain
+        n_domain = len(domain)
+        length = n_domain + self.url_length
+        surfixes = [short_url[n_domain:] for short_url in short_urls]
+
+        deletion = self._charset_deletion
+        if "".join(surfixes).translate(deletion) or any([
+            len(short_url) != length or not short_url.startswith(domain)
+            for short_url in short_urls
+        ]):
+            for short_url, surfix in zip(short_urls, surfixes):
+                if len(short_url) != length \
+                        or not short_url.startswith(domain) \
+                        or surfix.translate(deletion):
+                    raise ValueError(
+                        "It's not a valid short url: %r." % short_url)
+
+        decode = self.codec.decode
+        urls = self.storage.get_url_many([decode(surfix) for surfix in surfixes])
+        for surfix, url in zip(surfixes, urls):
+            if url is None:
+                raise ValueError("There's no match: %r." % surfix)
+        return urls
+
+
+def _assert_raises_value_error(func, *args):
+    try:
+        func(*args)
+    except ValueError:
+        return
+    raise AssertionError("%s%r didn't raise ValueError" % (func.__name__, args))
+
+
+class _TinyShortUrlService(BaseShortUrlService):
+    """8 short urls, expiring after 10 seconds.
+    """
+    domain = "https://t.co/"
+    charset = "ab"
+    url_length = 3
+    ttl = 10
+
+
+def test_expire():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for cache_size in [0, 4]:
+            for storage in [
+                MemoryStorage(),
+                SQLiteStorage(os.path.join(tmp_dir, "%s.db" % cache_size)),
+            ]:
+                klass = type("Service", (_TinyShortUrlService, ),
+                             {"cache_size": cache_size})
+                service = klass(storage)
+                short_urls = service.get_many(["u%s" % i for i in range(6)])
+                short_urls += [service.get("v0"), service.get("v1")]
+                assert len(set(short_urls)) == 8
+                assert service.parse(short_urls[0]) == "u0"
+                _assert_raises_value_error(service.get, "w")  # all in use
+
+                assert service.expire(time.time()) == []
+                expired = service.expire(time.time() + 11)
+                assert len(expired) == 8 and len(storage) == 0
+                _assert_raises_value_error(service.parse, short_urls[0])
+
+                # expired surfix are recycled
+                urls = ["w%s" % i for i in range(8)]
+                new_short_urls = service.get_many(urls)
+                assert sorted(new_short_urls) == sorted(short_urls)
+                assert service.parse_many(new_short_urls) == urls
+                # "v0" was cached by get, it's full now
+                _assert_raises_value_error(service.get, "v0")
+                storage.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+test_expire()
+
+
+def test_sqlite_reopen():
+    class Service(BaseShortUrlService):
+        domain = "https://t.co/"
+        charset = "abcdef"
+        url_length = 3
+        reserve_size = 10
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "short_url.db")
+    try:
+        urls = ["u%s" % i for i in range(25)]
+        service = Service(SQLiteStorage(path))
+        short_urls = service.get_many(urls[:20]) + [
+            service.get(url) for url in urls[20:]]
+        keys = service.permutation.keys
+        service.storage.close()
+
+        service = Service(SQLiteStorage(path))
+        assert service.permutation.keys == keys
+        assert service.parse_many(short_urls) == urls
+        assert service.get_many(urls) == short_urls
+        assert service.get("new") not in short_urls  # no surfix reissued
+        service.storage.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+test_sqlite_reopen()
+
+
+def test_hash_surfix():
+    class Service(BaseShortUrlService):
+        domain = "https://t.co/"
+        charset = string.ascii_lowercase + string.digits
+        url_length = 5
+        hash_surfix = True
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        urls = ["https://www.example.com/%s" % i for i in range(500)]
+        service = Service()
+        short_urls = [service.get(url) for url in urls]
+        assert len(set(short_urls)) == len(urls)
+        assert short_urls[0] == \
+            service.domain + service.codec.encode(service.hash_id(urls[0]))
+        # same surfix without shared state
+        other = Service(SQLiteStorage(os.path.join(tmp_dir, "hash.db")))
+        assert other.get_many(urls) == short_urls
+        assert other.parse_many(short_urls) == urls
+        other.storage.close()
+
+        # linear probing on collision
+        tiny = type("Service", (_TinyShortUrlService, ),
+                    {"hash_surfix": True})()
+        first = tiny.hash_id("u0")
+        colliding = [url for url in ["u%s" % i for i in range(1, 100)]
+                     if tiny.hash_id(url) == first][0]
+        assert tiny.get("u0") == tiny.domain + tiny.codec.encode(first)
+        assert tiny.get(colliding) == \
+            tiny.domain + tiny.codec.encode((first + 1) % tiny.capacity)
+        tiny.get_many(["x%s" % i for i in range(6)])
+        _assert_raises_value_error(tiny.get, "y")  # all in use
+
+        # expired surfix are not recycled
+        assert len(tiny.expire(time.time() + 11)) == 8
+        assert tiny.storage.pop_free(8) == []
+        assert tiny.get("u0") == tiny.domain + tiny.codec.encode(first)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+test_hash_surfix()
+
+
+def test_concurrent_get():
+    """8 threads on 4 services sharing a :class:`MemoryStorage`, or each
+    service with its own connection to one SQLite file, like processes.
+    """
+    class Service(BaseShortUrlService):
+        domain = "https://t.co/"
+        charset = string.ascii_lowercase + string.digits
+        url_length = 5
+        reserve_size = 20
+
+    def shorten(service, seed, pairs):
+        rnd = random.Random(seed)
+        for _ in range(200):
+            url = "u%s" % rnd.randrange(300)
+            if rnd.random() < 0.2:
+                urls = [url, url + "?b"]
+                pairs.extend(zip(urls, service.get_many(urls)))
+            else:
+                pairs.append((url, service.get(url)))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "shared.db")
+        memory_storage = MemoryStorage()
+        for make_service in [
+            lambda: Service(memory_storage),
+            lambda: Service(SQLiteStorage(path, batch_size=1)),
+        ]:
+            services = [make_service() for _ in range(4)]
+            pairs = list()
+            threads = [
+                threading.Thread(
+                    target=shorten, args=(services[i % 4], i, pairs))
+                for i in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            short_urls = dict()
+            for url, short_url in pairs:
+                assert short_urls.setdefault(url, short_url) == short_url
+            assert len(set(short_urls.values())) == len(short_urls)
+            assert len(services[0].storage) == len(short_urls)
+            urls = list(short_urls)
+            assert services[0].parse_many(
+                [short_urls[url] for url in urls]) == urls
+            for service in services:
+                service.storage.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+test_concurrent_get()
+
 
 if __name__ == "__main__":
     from sfm import rnd